@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import collections
+from contextlib import contextmanager
+from functools import wraps
+from application_logging.logger import logger, LOG_DIR, LOGNAME
+
+
+# Run records go next to the month's log file, one JSON object per line
+RUN_RECORD_PATH = os.path.join(LOG_DIR, LOGNAME + ".jsonl")
+
+_local = threading.local()
+_lock = threading.Lock()
+_finished = []
+_totals = collections.Counter()
+_run_started = time.time()
+
+
+class Span:
+    def __init__(self, name, parent):
+        self.path = name if parent is None else parent.path + "/" + name
+        self.started = time.time()
+        self.elapsed = None
+        self.thread = threading.current_thread().name
+        self.counters = collections.Counter()
+        self.error = None
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def span(name):
+    """Times the enclosed block as span ``name``, nested under the spans open on this thread.
+
+    Works as a context manager or a decorator. Counters counted while it is open
+    are added to it, and an exception escaping it is recorded on it.
+    """
+    stack = _stack()
+    current = Span(name, stack[-1] if stack else None)
+    stack.append(current)
+    started = time.perf_counter()
+    try:
+        yield current
+    except Exception as e:
+        current.error = repr(e)
+        raise
+    finally:
+        current.elapsed = time.perf_counter() - started
+        stack.remove(current)
+        with _lock:
+            _finished.append(current)
+
+
+def stage(name):
+    """Decorates a stage's ``run`` to time the whole stage as span ``name``."""
+
+    def decorate(run):
+        @wraps(run)
+        def timed(*args, **kwargs):
+            with span(name):
+                return run(*args, **kwargs)
+
+        return timed
+
+    return decorate
+
+
+def bind(fn):
+    """Wraps ``fn`` so that on a pool thread it still counts into the spans open here."""
+    spans = list(_stack())
+
+    @wraps(fn)
+    def bound(*args, **kwargs):
+        previous = _stack()
+        _local.stack = list(spans)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.stack = previous
+
+    return bound
+
+
+def count(name, value=1):
+    """Adds ``value`` to counter ``name`` of the run and of every span open on this thread."""
+    with _lock:
+        _totals[name] += value
+        for open_span in _stack():
+            open_span.counters[name] += value
+
+
+def count_response(service, response):
+    """Counts a ``requests`` response as one ``<service>.requests`` and its bytes both ways."""
+    body = response.request.body if response.request is not None else None
+    count(service + ".requests")
+    count("bytes_out", len(body or b""))
+    count("bytes_in", len(response.content or b""))
+
+
+class _ErrorCounter(logging.Handler):
+    # Stages log their failures instead of raising, count them on the open spans
+    def emit(self, record):
+        count("errors")
+
+
+logger.addHandler(_ErrorCounter(logging.ERROR))
+
+
+def flush(path=RUN_RECORD_PATH):
+    """Appends the spans finished since the last flush, and the run's totals, to ``path``.
+
+    Returns the flushed spans.
+    """
+    with _lock:
+        spans = list(_finished)
+        del _finished[:]
+        totals = dict(_totals)
+        _totals.clear()
+
+    run_id = "%s-%s" % (time.strftime("%Y%m%dT%H%M%S", time.gmtime(_run_started)), os.getpid())
+    records = [
+        {
+            "run": run_id,
+            "type": "span",
+            "span": finished.path,
+            "started": round(finished.started, 3),
+            "elapsed_s": round(finished.elapsed, 4),
+            "thread": finished.thread,
+            "error": finished.error,
+            "counters": dict(finished.counters),
+        }
+        for finished in sorted(spans, key=lambda finished: finished.started)
+    ]
+    records.append(
+        {
+            "run": run_id,
+            "type": "run",
+            "command": " ".join([os.path.basename(sys.argv[0])] + sys.argv[1:]),
+            "started": round(_run_started, 3),
+            "elapsed_s": round(time.time() - _run_started, 4),
+            "counters": totals,
+        }
+    )
+    with open(path, "a") as record_file:
+        for record in records:
+            record_file.write(json.dumps(record) + "\n")
+    return spans
+
+
+def summary(spans):
+    """Formats spans as a table with one row per span path, children below their parent."""
+    rows = collections.OrderedDict()
+    for finished in spans:
+        row = rows.setdefault(finished.path, {"n": 0, "total": 0.0, "max": 0.0, "counters": collections.Counter()})
+        row["n"] += 1
+        row["total"] += finished.elapsed
+        row["max"] = max(row["max"], finished.elapsed)
+        row["counters"].update(finished.counters)
+
+    lines = ["%-40s %5s %10s %10s %9s %9s %10s %10s %6s" % ("span", "n", "total (s)", "max (s)", "requests", "rpc calls", "KB in", "KB out", "errors")]
+    for path in sorted(rows):
+        row = rows[path]
+        counters = row["counters"]
+        requests = sum(value for name, value in counters.items() if name.endswith(".requests"))
+        name = "  " * path.count("/") + path.rsplit("/", 1)[-1]
+        lines.append(
+            "%-40s %5d %10.3f %10.3f %9d %9d %10.1f %10.1f %6d"
+            % (
+                name,
+                row["n"],
+                row["total"],
+                row["max"],
+                requests,
+                counters["rpc.calls"],
+                counters["bytes_in"] / 1024,
+                counters["bytes_out"] / 1024,
+                counters["errors"],
+            )
+        )
+    return "\n".join(lines)
+
+
+def report():
+    """Writes the run record and logs and prints the summary table; call once at the end of a run."""
+    spans = flush()
+    table = summary(spans)
+    logger.info("Run summary:\n%s" % table)
+    print(table)
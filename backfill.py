@@ -0,0 +1,181 @@
+import argparse
+import multiprocessing
+import concurrent.futures
+import pandas as pd
+from application_logging.logger import logger
+from application_logging.instrumentation import span, report
+from retro_utils.context import RunContext, params_path
+from retro_utils.epochs import epoch_of, epoch_start
+import bribe_data
+import fee_data
+import vote_data
+import revenue_data
+
+
+# Stage name -> (on-chain fetch for some gauges, builder of an epoch's rows, sheet key, row key columns)
+STAGES = {
+    "bribe_data": (bribe_data.fetch_bribes, bribe_data.bribe_amounts, "bribe_data_sheet_key", ["epoch", "name_pool", "address"]),
+    "fee_data": (fee_data.fetch_fees, fee_data.fee_amounts, "fee_data_sheet_key", ["epoch", "name_pool", "address"]),
+    "vote_data": (vote_data.fetch_vote_weights, vote_data.vote_values, "vote_data_sheet_key", ["epoch", "name_pool"]),
+}
+
+# Per worker process state, set up by _init_worker
+_worker_ctx = None
+_rpc_slots = None
+
+
+def _init_worker(config_path, rpc_slots):
+    global _worker_ctx, _rpc_slots
+    _worker_ctx = RunContext(config_path)
+    _rpc_slots = rpc_slots
+
+
+def _fetch_shard(stage, ids_df, timestamp):
+    fetch = STAGES[stage][0]
+    with _rpc_slots:
+        return fetch(_worker_ctx, ids_df, timestamp)
+
+
+def missing_rows(df, existing_df, key_columns):
+    """Rows of ``df`` whose key columns match no row of ``existing_df``."""
+    keys = pd.MultiIndex.from_frame(df[key_columns].astype(str))
+    existing_keys = pd.MultiIndex.from_frame(existing_df[key_columns].astype(str))
+    return df[~keys.isin(existing_keys)]
+
+
+@span("backfill")
+def backfill(ctx, stages, epochs, workers=4, rpc_concurrency=4, shard_size=25, publish=True):
+    """Fills in ``stages`` for past ``epochs``, one task per (stage, epoch, shard of gauges).
+
+    Shards are fetched on a pool of ``workers`` processes, with at most
+    ``rpc_concurrency`` of them talking to the RPC at a time. Each epoch is
+    valued once all its shards are in, in epoch order, so an interrupted
+    backfill leaves a contiguous history behind. An epoch with a failed shard
+    is not written. Only rows whose key the store does not hold yet are added:
+    new rows are valued at the current price snapshot, the only one the price
+    API serves, so recorded rows keep the values of their own epoch, and rows
+    of pools since delisted stay. Revenue of the first filled epoch on is then
+    rebuilt, as the revenue stage itself only rebuilds the running epochs.
+    With ``publish`` the filled epochs and the rebuilt revenue are synced to
+    their sheets. Returns the filled epochs per stage.
+    """
+    ids_df = ctx.ids_df
+    shards = [ids_df.iloc[start:start + shard_size] for start in range(0, len(ids_df), shard_size)]
+    epochs = sorted(epochs)
+
+    parts = {(stage, epoch): [] for stage in stages for epoch in epochs}
+    remaining = {key: len(shards) for key in parts}
+    failed = set()
+    next_index = {stage: 0 for stage in stages}
+    written = {stage: [] for stage in stages}
+
+    def flush(stage):
+        # Writes the stage's completed epochs that have no pending epoch before them
+        while next_index[stage] < len(epochs) and remaining[(stage, epochs[next_index[stage]])] == 0:
+            epoch = epochs[next_index[stage]]
+            next_index[stage] += 1
+            if (stage, epoch) in failed:
+                continue
+            raw_df = pd.concat(parts.pop((stage, epoch)), ignore_index=True)
+            if raw_df.empty:
+                logger.warning("Backfill %s: no rows for epoch %s" % (stage, epoch))
+                continue
+            df = STAGES[stage][1](raw_df, ctx.prices, epoch)
+            # Epoch is already fixed by the read, the other key columns tell rows apart
+            key_columns = [column for column in STAGES[stage][3] if column != "epoch"]
+            df = missing_rows(df, ctx.store.read(stage, where={"epoch": epoch}, columns=key_columns), key_columns)
+            if df.empty:
+                logger.info("Backfill %s: epoch %s is complete already" % (stage, epoch))
+                continue
+            ctx.store.write(stage, df)
+            written[stage].append(epoch)
+            logger.info("Backfill %s: added %s rows to epoch %s" % (stage, len(df), epoch))
+
+    rpc_slots = multiprocessing.Semaphore(rpc_concurrency)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(ctx.config_path, rpc_slots)
+    ) as executor:
+        futures = {}
+        for epoch in epochs:
+            # An epoch's rows are read at its end, as the weekly run does
+            timestamp = epoch_start(epoch + 1)
+            for stage in stages:
+                for shard in shards:
+                    futures[executor.submit(_fetch_shard, stage, shard, timestamp)] = (stage, epoch)
+
+        for future in concurrent.futures.as_completed(futures):
+            stage, epoch = futures[future]
+            try:
+                parts[(stage, epoch)].append(future.result())
+            except Exception as e:
+                logger.error("Backfill %s failed for epoch %s. Error: %s" % (stage, epoch, e), exc_info=True)
+                failed.add((stage, epoch))
+            remaining[(stage, epoch)] -= 1
+            flush(stage)
+
+    filled = [epoch for stage in stages for epoch in written[stage]]
+    if not filled:
+        return written
+
+    # Revenue Rebuild
+    first_epoch = min(filled)
+    revenue_df = revenue_data.build_from(ctx.store, first_epoch)
+    ctx.store.write("revenue_data", revenue_df, replace={"epoch": (">=", first_epoch)})
+    logger.info("Backfill revenue_data: rebuilt %s rows from epoch %s" % (len(revenue_df), first_epoch))
+
+    if publish:
+        for stage in stages:
+            if not written[stage]:
+                continue
+            epochs_written = {str(epoch) for epoch in written[stage]}
+            ctx.publisher.sync(
+                ctx.config["gsheets"][STAGES[stage][2]],
+                "Master",
+                ctx.store.read(stage, where={"epoch": written[stage]}),
+                STAGES[stage][3],
+                lambda keys, epochs_written=epochs_written: keys["epoch"].isin(epochs_written),
+            )
+        ctx.publisher.sync(
+            ctx.config["gsheets"]["revenue_data_sheet_key"],
+            "Master",
+            revenue_df,
+            ["epoch", "name_pool"],
+            lambda keys: pd.to_numeric(keys["epoch"], errors="coerce") >= first_epoch,
+        )
+        ctx.publisher.flush()
+
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill in past epochs of the bribe, fee and vote data")
+    parser.add_argument("stages", nargs="*", help="default: all stages")
+    parser.add_argument("--from-epoch", type=int, required=True)
+    parser.add_argument("--to-epoch", type=int, required=True, help="Last epoch to fill, inclusive")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rpc-concurrency", type=int, default=4)
+    parser.add_argument("--shard-size", type=int, default=25, help="Gauges per task")
+    parser.add_argument("--no-publish", action="store_true", help="Only write to the store")
+    args = parser.parse_args()
+    # argparse rejects a list default of a nargs="*" positional with choices
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error("unknown stages: %s" % ", ".join(sorted(unknown)))
+    args.stages = args.stages or list(STAGES)
+
+    ctx = RunContext(params_path)
+    current_epoch = epoch_of(ctx.epoch_timestamp) - 1
+    if not 0 <= args.from_epoch <= args.to_epoch <= current_epoch:
+        parser.error("epochs must be within 0 and the current epoch %s" % current_epoch)
+
+    written = backfill(
+        ctx,
+        args.stages,
+        range(args.from_epoch, args.to_epoch + 1),
+        workers=args.workers,
+        rpc_concurrency=args.rpc_concurrency,
+        shard_size=args.shard_size,
+        publish=not args.no_publish,
+    )
+    logger.info("Backfill filled epochs %s" % written)
+    report()
@@ -0,0 +1,52 @@
+import sys
+import os
+import time
+import random
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from retro_utils.amounts import normalize_amounts
+
+
+def loop_amounts(price, raw, decimals):
+    # The per-row conversion the stage scripts used before normalize_amounts
+    amounts = price * raw
+    result = []
+    for dec, amt in zip(decimals, amounts):
+        decimal = "1"
+        decimal = decimal.ljust(dec + 1, "0")
+        result.append((amt / int(decimal)))
+    return result
+
+
+def timed(fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(rows=100000):
+    random.seed(0)
+    decimals = pd.Series(random.choices([6, 8, 18], k=rows))
+    price = pd.Series(np.random.default_rng(0).uniform(0.01, 2000, rows))
+    cases = {
+        # Amounts that fit in int64 and below 2**53
+        "small int64": pd.Series([random.randrange(1, 2 ** 53) for _ in range(rows)]),
+        # 18-decimal uint256 amounts, held as Python ints in an object column
+        "uint256 object": pd.Series([random.randrange(10 ** 15, 10 ** 27) for _ in range(rows)], dtype=object),
+    }
+
+    print("%-16s %12s %12s %8s %14s" % ("case", "loop (s)", "vector (s)", "speedup", "max rel diff"))
+    for name, raw in cases.items():
+        loop_time, expected = timed(lambda: loop_amounts(price, raw, decimals))
+        vector_time, actual = timed(lambda: price * normalize_amounts(raw, decimals))
+        rel_diff = np.max(np.abs(np.asarray(actual) - np.asarray(expected, dtype=float)) / np.asarray(expected, dtype=float))
+        print("%-16s %12.4f %12.4f %7.1fx %14.2e" % (name, loop_time, vector_time, loop_time / vector_time, rel_diff))
+
+
+if __name__ == "__main__":
+    main()
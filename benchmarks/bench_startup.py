@@ -0,0 +1,97 @@
+import sys
+import os
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Stage scripts as the workflows start them
+SCRIPTS = [
+    "id_data",
+    "day_data",
+    "pair_data",
+    "bribe_data",
+    "fee_data",
+    "vote_data",
+    "emissions_data",
+    "revenue_data",
+    "partner_data",
+    "apr_data",
+    "pool_data",
+    "run_pipeline",
+    "backfill",
+]
+
+# What a script does before its first request: import itself and read the config
+STARTUP = """
+import time
+started = time.perf_counter()
+import %s
+from retro_utils.context import RunContext
+RunContext().config
+print(time.perf_counter() - started)
+"""
+
+
+def run_python(args, workdir):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get("PYTHONPATH", "")]))
+    return subprocess.run(
+        [sys.executable] + args, cwd=workdir, env=env, check=True, capture_output=True, text=True
+    )
+
+
+def startup_times(script, workdir, repeat):
+    return [float(run_python(["-c", STARTUP % script], workdir).stdout.split()[-1]) for _ in range(repeat)]
+
+
+def slowest_imports(script, workdir, top=10):
+    """The modules ``script`` imports directly, by cumulative import time, slowest first."""
+    # -X importtime prints "import time: self [us] | cumulative | imported package" to
+    # stderr after each module is loaded, indented two spaces deeper than its importer
+    stderr = run_python(["-X", "importtime", "-c", "import %s" % script], workdir).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if line.startswith("import time:") and "cumulative" not in line:
+            _, cumulative_us, name = line.split(":", 1)[1].split("|")
+            rows.append((len(name) - len(name.lstrip()), int(cumulative_us), name.strip()))
+
+    position = max(i for i, (indent, _, name) in enumerate(rows) if name == script and indent == 1)
+    imports = []
+    for indent, cumulative_us, name in reversed(rows[:position]):
+        if indent <= 1:
+            break
+        if indent == 3:
+            imports.append((cumulative_us, name))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start time of each script: its imports and reading params.yaml")
+    parser.add_argument("scripts", nargs="*", help="default: every stage script")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--imports", action="store_true", help="also list each script's slowest imports")
+    args = parser.parse_args()
+    unknown = set(args.scripts) - set(SCRIPTS)
+    if unknown:
+        parser.error("unknown scripts: %s" % ", ".join(sorted(unknown)))
+
+    # Scripts log to ./logs, run them from a scratch copy of the config
+    workdir = tempfile.mkdtemp(prefix="retro-startup-")
+    shutil.copy(os.path.join(ROOT, "params.yaml"), workdir)
+    try:
+        print("%-16s %10s %10s" % ("script", "min (s)", "median (s)"))
+        for script in args.scripts or SCRIPTS:
+            times = startup_times(script, workdir, args.repeat)
+            print("%-16s %10.3f %10.3f" % (script, min(times), statistics.median(times)))
+            if args.imports:
+                for cumulative_us, name in slowest_imports(script, workdir):
+                    print("    %-36s %8.3f" % (name, cumulative_us / 1e6))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,532 @@
+import io
+import bisect
+import re
+import csv
+import json
+import time
+import hashlib
+import threading
+from urllib.parse import urlparse, parse_qs, unquote
+from eth_abi import decode_abi, encode_abi
+from eth_utils import function_abi_to_4byte_selector
+from web3._utils.abi import get_abi_input_types, get_abi_output_types
+from transport import Response
+from retro_utils.abis import load_abi, load_events
+from retro_utils.epochs import epoch_of, epoch_start
+
+
+# Synthetic chain: block n is mined at CHAIN_START + BLOCK_TIME * n
+CHAIN_START = 1590000000
+BLOCK_TIME = 2
+PERIOD_BLOCKS = 7 * 24 * 60 * 60 // BLOCK_TIME
+
+# Widest eth_getLogs range the fake node accepts
+LOG_RANGE_LIMIT = 50000
+
+ZERO_ADDRESS = "0x" + "0" * 40
+
+# Header and a first row of each history sheet, so the store seeds typed tables from their exports
+SHEET_HISTORY = {
+    "daily_data_fusion": [
+        ["id", "date", "volumeUSD", "feesUSD", "tvlUSD", "__typename"],
+        ["19565", "2023-07-27", "0.0", "0.0", "0.0", "Fusion"],
+    ],
+    "pair_data_fusion": [
+        [
+            "id", "date", "tvlUSD", "volumeUSD", "volumeToken0", "volumeToken1", "token0Price",
+            "token1Price", "feesUSD", "__typename", "name", "underlyingPool", "type", "epoch",
+        ],
+        ["0x0-19565", "2023-07-27", "0.0", "0.0", "0.0", "0.0", "0.0", "0.0", "0.0", "Fusion", "seed", "0x0", "seed", "0"],
+    ],
+    "bribe_data": [
+        ["name_pool", "address", "name_token", "price", "bribe_amount", "epoch"],
+        ["seed", "0x0", "seed", "0.0", "0.0", "0"],
+    ],
+    "fee_data": [
+        ["name_pool", "address", "name_token", "price", "fee_amount", "epoch"],
+        ["seed", "0x0", "seed", "0.0", "0.0", "0"],
+    ],
+    "vote_data": [
+        ["name_pool", "epoch", "voteweight", "RETRO_price", "votevalue"],
+        ["seed", "0", "0.0", "0.0", "0.0"],
+    ],
+    "emissions_data": [
+        ["epoch", "symbol", "emissions", "value", "RETRO_price", "oRETRO_price"],
+        ["0", "seed", "0.0", "0.0", "0.0", "0.0"],
+    ],
+    "revenue_data": [
+        [
+            "epoch", "name_pool", "fee_amount", "total_feesUSD", "bribe_amount", "voter_share", "revenue",
+            "bribe_amount_offset", "voteweight", "RETRO_price", "votevalue", "vote_apr", "emissions",
+            "emissions_value", "oRETRO_price",
+        ],
+        ["0", "seed", "0.0", "0.0", "0.0", "0.0", "0.0", "0.0", "0.0", "0.0", "0.0", "0.0", "0.0", "0.0", "0.0"],
+    ],
+}
+
+
+def _number(*parts):
+    # Deterministic pseudo random integer for a request
+    return int(hashlib.sha256(repr(parts).encode()).hexdigest()[:16], 16)
+
+
+def _address(*parts):
+    return "0x" + hashlib.sha256(repr(parts).encode()).hexdigest()[:40]
+
+
+def _json(body, status=200):
+    return Response(status, json.dumps(body), {"Content-Type": "application/json"})
+
+
+class FakeServices:
+    """Synthetic stand-ins for every service the stages talk to, answering by host.
+
+    The data is generated from the checked in ids and partners so it has the
+    size of the real thing: price and fusion REST API, fusion subgraph (GraphQL,
+    with pagination), Polygon JSON-RPC (including Multicall3 and batches), DefiLlama
+    blocks, Dune (emissions), Google OAuth, the Sheets API (in memory, keeps what is written)
+    and the sheet CSV exports, and raw.githubusercontent.com (served from data/).
+    """
+
+    def __init__(self, config, ids_df, partners_df):
+        self.config = config
+        self.ids_df = ids_df
+        self.partners_df = partners_df
+        self._lock = threading.Lock()
+
+        tokens = [("RETRO", 18), ("oRETRO", 18), ("USDC", 6), ("WETH", 18), ("WMATIC", 18), ("WBTC", 8)]
+        tokens += [("TOKEN%s" % i, 18) for i in range(20)]
+        self.assets = [
+            {"name": name, "address": _address("token", name), "price": 1 + _number("price", name) % 2000 / 7, "decimals": decimals}
+            for name, decimals in tokens
+        ]
+
+        self.abis = {}
+        for name in ["bribe", "gauge", "veRETRO", "merkl", "multicall"]:
+            for fn in load_abi(name):
+                if fn.get("type") == "function":
+                    self.abis.setdefault(function_abi_to_4byte_selector(fn), fn)
+
+        self.reward_logs = self._reward_logs()
+        self.reward_blocks = [int(log["blockNumber"], 16) for log in self.reward_logs]
+
+        self.sheets = {}
+        for table, rows in SHEET_HISTORY.items():
+            self.sheets[_sheet_id(config["files"][table])] = {"rows": [list(row) for row in rows], "row_count": 1000}
+
+        self.routes = [
+            (urlparse(config["api"]["price_api"]).path, self._assets),
+            (urlparse(config["api"]["fusion_api"]).path, self._fusions),
+        ]
+
+    def __call__(self, request, forward):
+        host = request.host
+        if host == urlparse(self.config["api"]["price_api"]).netloc:
+            path = urlparse(request.url).path
+            for route, handler in self.routes:
+                if path == route:
+                    return handler(request)
+        if host == urlparse(self.config["query"]["fusion_subgraph"]).netloc:
+            return self._graphql(request)
+        if host == "api.dune.com":
+            return self._dune(request)
+        if host == "coins.llama.fi":
+            timestamp = int(urlparse(request.url).path.rsplit("/", 1)[1])
+            return _json({"height": (timestamp - CHAIN_START) // BLOCK_TIME, "timestamp": timestamp})
+        if host == "iamcredentials.googleapis.com":
+            return _json({"locations": [], "encodedLocations": "0x0"})
+        if host == "oauth2.googleapis.com":
+            return _json({"access_token": "fake", "expires_in": 3600, "token_type": "Bearer"})
+        if host == "sheets.googleapis.com":
+            return self._sheets(request)
+        if host == "docs.google.com":
+            return self._export(request)
+        if host == "raw.githubusercontent.com":
+            return self._raw(request)
+        if isinstance(request.json(), (dict, list)) and "jsonrpc" in request.body.decode("utf-8", "replace"):
+            return self._rpc(request)
+        return Response(404, "No fake for %s" % request.url)
+
+    # REST
+
+    def _assets(self, request):
+        return _json({"data": self.assets})
+
+    def _fusions(self, request):
+        rows = []
+        for row in self.ids_df.to_dict("records"):
+            rows.append(
+                {
+                    "symbol": row["symbol"],
+                    "address": row["address"],
+                    "isGamma": row["isGamma"],
+                    "feeLevel": row["feeLevel"],
+                    "underlyingPool": row["underlyingPool"],
+                    "type": row["type"],
+                    "gauge": {"address": row["gauge.address"], "fee": row["gauge.fee"], "bribe": row["gauge.bribe"]},
+                }
+            )
+        return _json({"data": rows})
+
+    def _raw(self, request):
+        name = urlparse(request.url).path.rsplit("/", 1)[1]
+        try:
+            with open("data/" + name, "rb") as data_file:
+                return Response(200, data_file.read(), {"Content-Type": "text/plain"})
+        except OSError:
+            return Response(404, "Not found")
+
+    # GraphQL
+
+    def _graphql(self, request):
+        body = request.json()
+        variables = body.get("variables", {})
+        today = int(time.time()) // 86400 * 86400
+        if "uniswapDayDatas" in body["query"]:
+            days = range(variables["startTime"] // 86400 * 86400 + 86400, today + 1, 86400)
+            rows = [
+                {
+                    "id": str(day // 86400),
+                    "date": day,
+                    "volumeUSD": str(_number("volume", day) % 10 ** 7),
+                    "feesUSD": str(_number("fees", day) % 10 ** 4),
+                    "tvlUSD": str(_number("tvl", day) % 10 ** 8),
+                    "__typename": "UniswapDayData",
+                }
+                for day in days
+            ]
+            return _json({"data": {"uniswapDayDatas": rows[: variables["first"]]}})
+
+        rows = []
+        for pool in variables["pairAddresses"]:
+            for day in range(variables["startTime"] // 86400 * 86400 + 86400, today + 1, 86400):
+                row_id = "%s-%s" % (pool, day // 86400)
+                if row_id > variables.get("lastId", ""):
+                    rows.append(
+                        {
+                            "id": row_id,
+                            "date": day,
+                            "pool": {"id": pool},
+                            "tvlUSD": str(_number("tvl", pool, day) % 10 ** 7),
+                            "volumeUSD": str(_number("volume", pool, day) % 10 ** 6),
+                            "volumeToken0": str(_number("v0", pool, day) % 10 ** 6),
+                            "volumeToken1": str(_number("v1", pool, day) % 10 ** 6),
+                            "token0Price": str(_number("p0", pool) % 1000 / 10),
+                            "token1Price": str(_number("p1", pool) % 1000 / 10),
+                            "feesUSD": str(_number("fees", pool, day) % 10 ** 4),
+                            "__typename": "PoolDayData",
+                        }
+                    )
+        rows.sort(key=lambda row: row["id"])
+        return _json({"data": {"poolDayDatas": rows[: variables["first"]]}})
+
+    # JSON-RPC
+
+    def _rpc(self, request):
+        body = request.json()
+        if isinstance(body, list):
+            return _json([self._rpc_call(call) for call in body])
+        return _json(self._rpc_call(body))
+
+    def _rpc_call(self, call):
+        method, params = call["method"], call.get("params", [])
+        head = (int(time.time()) - CHAIN_START) // BLOCK_TIME
+        if method == "eth_chainId":
+            result = "0x89"
+        elif method == "net_version":
+            result = "137"
+        elif method == "eth_blockNumber":
+            result = hex(head)
+        elif method == "eth_getBlockByNumber":
+            number = head if params[0] == "latest" else int(params[0], 16)
+            result = None if number > head else {"number": hex(number), "timestamp": hex(CHAIN_START + BLOCK_TIME * number)}
+        elif method == "eth_call":
+            result = "0x" + self._eth_call(params[0]["to"], bytes.fromhex(params[0]["data"][2:])).hex()
+        elif method == "eth_getLogs":
+            return self._get_logs(call, params[0])
+        else:
+            return {"jsonrpc": "2.0", "id": call.get("id"), "error": {"code": -32601, "message": "Method not found"}}
+        return {"jsonrpc": "2.0", "id": call.get("id"), "result": result}
+
+    def _eth_call(self, to, data):
+        fn = self.abis.get(data[:4])
+        if fn is None:
+            return b""
+        args = decode_abi(get_abi_input_types(fn), data[4:])
+        name = fn["name"]
+        if name == "aggregate3":
+            return encode_abi(["(bool,bytes)[]"], [[(True, self._eth_call(target, call_data)) for target, _, call_data in args[0]]])
+        if name == "rewardsListLength":
+            values = [2]
+        elif name == "rewardTokens":
+            values = [self.assets[_number(to, args[0]) % len(self.assets)]["address"]]
+        elif name == "rewardData":
+            values = [args[1], _number(to, args) % 10 ** 21, args[1]]
+        elif name == "balanceOfOwnerAt":
+            number = _number(to, args)
+            values = [number % 10 ** 22 if number % 3 == 0 else 0]
+        elif name == "getActivePoolDistributions":
+            values = [self._distributions(args[0])]
+        else:
+            values = [_value(output_type, to, args) for output_type in get_abi_output_types(fn)]
+        return encode_abi(get_abi_output_types(fn), values)
+
+    def _distributions(self, pool):
+        # Most pools have one Merkl distribution, with both pool balances
+        if _number("merkl", pool) % 4 == 0:
+            return []
+        tokens = []
+        for side in range(2):
+            asset = self.assets[_number("merkl", pool, side) % len(self.assets)]
+            balance = _number("balance", pool, side) % 10 ** (asset["decimals"] + 6)
+            tokens.append((asset["address"], asset["decimals"], asset["name"], balance))
+        base = (bytes(32), pool, self.assets[1]["address"], 10 ** 23, [], [], 100, 100, 9800, 0, 168, 0, 0, ZERO_ADDRESS, b"")
+        return [(base, 500, tokens[0], tokens[1], "oRETRO", 18)]
+
+    def _reward_logs(self):
+        # RewardAdded logs of partner bribes, deposited during the last few epochs, each
+        # after the Transfer that pulls the reward in and before an NFT transfer to the bribe
+        reward_added = load_events("bribe")["RewardAdded"]
+        transfer = load_events("erc20")["Transfer"]
+        bribes = [bribe.lower() for bribe in self.ids_df["gauge.bribe"] if bribe != ZERO_ADDRESS]
+        current = int(epoch_of(time.time()))
+        logs = []
+        for epoch in range(current - 3, current + 1):
+            first_block = (int(epoch_start(epoch)) - CHAIN_START) // BLOCK_TIME
+            for provider in self.partners_df["nft_address"].str.lower():
+                for bribe in bribes:
+                    if _number(provider, bribe) % 4 != 0:
+                        continue
+                    tx_hash = "0x" + hashlib.sha256(repr(("tx", provider, bribe, epoch)).encode()).hexdigest()
+                    token = self.assets[_number(provider, bribe) % len(self.assets)]["address"]
+                    amount = _number("bribe", provider, bribe, epoch) % 10 ** 21
+                    data = encode_abi(["address", "uint256", "uint256"], [token, amount, int(epoch_start(epoch + 1))])
+                    block = first_block + _number("block", provider, bribe) % (PERIOD_BLOCKS - 1)
+                    logs.append(
+                        {
+                            "address": token,
+                            "topics": [transfer.topic, _topic(provider), _topic(bribe)],
+                            "data": "0x" + encode_abi(["uint256"], [amount]).hex(),
+                            "blockNumber": hex(block),
+                            "transactionHash": tx_hash,
+                            "logIndex": "0x0",
+                        }
+                    )
+                    logs.append(
+                        {
+                            "address": bribe,
+                            "topics": [reward_added.topic],
+                            "data": "0x" + data.hex(),
+                            "blockNumber": hex(block),
+                            "transactionHash": tx_hash,
+                            "logIndex": "0x1",
+                        }
+                    )
+                    # An ERC721 Transfer shares the ERC20 topic0 but indexes the tokenId
+                    # as a fourth topic and carries no data
+                    logs.append(
+                        {
+                            "address": provider,
+                            "topics": [transfer.topic, _topic(provider), _topic(bribe), "0x%064x" % _number("nft", provider, epoch)],
+                            "data": "0x",
+                            "blockNumber": hex(block),
+                            "transactionHash": tx_hash,
+                            "logIndex": "0x2",
+                        }
+                    )
+        logs.sort(key=lambda log: int(log["blockNumber"], 16))
+        return logs
+
+    def _get_logs(self, call, log_filter):
+        from_block, to_block = int(log_filter["fromBlock"], 16), int(log_filter["toBlock"], 16)
+        if to_block - from_block + 1 > LOG_RANGE_LIMIT:
+            error = {"code": -32005, "message": "block range too large, max %s" % LOG_RANGE_LIMIT}
+            return {"jsonrpc": "2.0", "id": call.get("id"), "error": error}
+        addresses = {address.lower() for address in log_filter.get("address", [])}
+        topics = [topic if topic is None or isinstance(topic, list) else [topic] for topic in log_filter["topics"]]
+        start, end = bisect.bisect_left(self.reward_blocks, from_block), bisect.bisect_right(self.reward_blocks, to_block)
+        result = [
+            log
+            for log in self.reward_logs[start:end]
+            if (not addresses or log["address"] in addresses)
+            and len(log["topics"]) >= len(topics)
+            and all(topic is None or log["topics"][position] in topic for position, topic in enumerate(topics))
+        ]
+        return {"jsonrpc": "2.0", "id": call.get("id"), "result": result}
+
+    # Dune
+
+    def _dune(self, request):
+        path = urlparse(request.url).path
+        query = parse_qs(urlparse(request.url).query)
+        match = re.search(r"/(query|execution)/([^/]+)/(\w+)$", path)
+        kind, item_id, action = match.groups()
+        if kind == "query" and action == "execute":
+            return _json({"execution_id": item_id, "state": "QUERY_STATE_PENDING"})
+        if kind == "query":
+            return _json({"error": "no latest result"}, status=404)
+        if action == "status":
+            return _json({"execution_id": item_id, "state": "QUERY_STATE_COMPLETED"})
+
+        rows = self._dune_rows(item_id)
+        limit = int(query.get("limit", [len(rows)])[0])
+        offset = int(query.get("offset", [0])[0])
+        next_offset = offset + limit if offset + limit < len(rows) else None
+        ended_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        return _json(
+            {
+                "execution_id": item_id,
+                "execution_ended_at": ended_at,
+                "result": {"rows": rows[offset : offset + limit]},
+                "next_offset": next_offset,
+            }
+        )
+
+    def _dune_rows(self, query_id):
+        gauges = [gauge for gauge in self.ids_df["gauge.address"] if gauge != ZERO_ADDRESS]
+        return [
+            {
+                "evt_tx_hash": _address("tx", gauge),
+                "evt_index": 0,
+                "evt_block_time": "",
+                "evt_block_number": 0,
+                "gauge": gauge,
+                "reward": str(_number("emissions", gauge) % 10 ** 23),
+            }
+            for gauge in gauges
+        ]
+
+    # Google Sheets
+
+    def _sheet(self, sheet_id):
+        return self.sheets.setdefault(sheet_id, {"rows": [], "row_count": 1000})
+
+    def _export(self, request):
+        sheet = self._sheet(_sheet_id(request.url))
+        output = io.StringIO()
+        csv.writer(output).writerows(sheet["rows"])
+        return Response(200, output.getvalue(), {"Content-Type": "text/csv"})
+
+    def _sheets(self, request):
+        parsed = urlparse(request.url)
+        match = re.match(r"/v4/spreadsheets/([^/:]+)(.*)$", parsed.path)
+        sheet_id, rest = match.group(1), unquote(match.group(2))
+        body = request.json() or {}
+        with self._lock:
+            sheet = self._sheet(sheet_id)
+            rows = sheet["rows"]
+            if rest == "":
+                return _json(
+                    {
+                        "spreadsheetId": sheet_id,
+                        "properties": {"title": sheet_id},
+                        "sheets": [
+                            {
+                                "properties": {
+                                    "sheetId": 0,
+                                    "title": "Master",
+                                    "index": 0,
+                                    "sheetType": "GRID",
+                                    "gridProperties": {"rowCount": sheet["row_count"], "columnCount": 26},
+                                }
+                            }
+                        ],
+                    }
+                )
+            if rest == "/values:batchGet":
+                ranges = parse_qs(parsed.query).get("ranges", [])
+                return _json({"spreadsheetId": sheet_id, "valueRanges": [_read_range(rows, a1) for a1 in ranges]})
+            if rest == ":batchUpdate":
+                for update in body.get("requests", []):
+                    _apply_update(sheet, update)
+                return _json({"spreadsheetId": sheet_id, "replies": [{} for _ in body.get("requests", [])]})
+            if rest.endswith(":append"):
+                rows.extend([[str(value) for value in row] for row in body.get("values", [])])
+                sheet["row_count"] = max(sheet["row_count"], len(rows))
+                return _json({"spreadsheetId": sheet_id, "updates": {"updatedRows": len(body.get("values", []))}})
+            if rest.endswith(":clear"):
+                del rows[:]
+                return _json({"spreadsheetId": sheet_id, "clearedRange": rest})
+            if rest.startswith("/values/"):
+                row, column = _range_start(rest[len("/values/"):])
+                _write(rows, row, column, body.get("values", []))
+                return _json({"spreadsheetId": sheet_id, "updatedRows": len(body.get("values", []))})
+            if rest == "/values:batchUpdate":
+                for value_range in body.get("data", []):
+                    row, column = _range_start(value_range["range"])
+                    _write(rows, row, column, value_range.get("values", []))
+                return _json({"spreadsheetId": sheet_id, "responses": []})
+        return Response(404, "No fake for %s" % request.url)
+
+
+def _value(abi_type, *seed):
+    if abi_type.endswith("]"):
+        return []
+    if abi_type.startswith(("uint", "int")):
+        return _number(abi_type, seed) % 10 ** 24
+    if abi_type == "address":
+        return ZERO_ADDRESS
+    if abi_type == "bool":
+        return True
+    if abi_type == "string":
+        return "fake"
+    if abi_type == "bytes":
+        return b""
+    if abi_type.startswith("bytes"):
+        return bytes(int(abi_type[5:]))
+    return 0
+
+
+def _topic(address):
+    return "0x" + "0" * 24 + address.lower()[2:]
+
+
+def _sheet_id(url):
+    match = re.search(r"/d/([^/]+)", url)
+    return match.group(1) if match else url
+
+
+def _range_start(a1):
+    # "Master!B2:B" -> (1, 1), zero based
+    cells = a1.split("!")[-1].split(":")[0]
+    match = re.match(r"([A-Z]*)(\d*)", cells)
+    letters, digits = match.groups()
+    column = 0
+    for letter in letters:
+        column = column * 26 + ord(letter) - 64
+    return (int(digits) - 1 if digits else 0), max(column - 1, 0)
+
+
+def _read_range(rows, a1):
+    row, column = _range_start(a1)
+    values = [[data_row[column]] if column < len(data_row) and data_row[column] != "" else [] for data_row in rows[row:]]
+    while values and not values[-1]:
+        values.pop()
+    return {"range": a1, "majorDimension": "ROWS", "values": values}
+
+
+def _write(rows, row, column, values):
+    for offset, values_row in enumerate(values):
+        while len(rows) <= row + offset:
+            rows.append([])
+        target = rows[row + offset]
+        while len(target) < column + len(values_row):
+            target.append("")
+        target[column : column + len(values_row)] = ["" if value is None else str(value) for value in values_row]
+
+
+def _apply_update(sheet, update):
+    rows = sheet["rows"]
+    if "pasteData" in update:
+        paste = update["pasteData"]
+        values = [line.split(paste.get("delimiter", ",")) for line in paste["data"].split("\n")]
+        _write(rows, paste["coordinate"].get("rowIndex", 0), paste["coordinate"].get("columnIndex", 0), values)
+    elif "deleteDimension" in update:
+        dimension = update["deleteDimension"]["range"]
+        del rows[dimension["startIndex"] : dimension["endIndex"]]
+        sheet["row_count"] -= dimension["endIndex"] - dimension["startIndex"]
+    elif "appendDimension" in update:
+        sheet["row_count"] += update["appendDimension"]["length"]
+    elif "updateSheetProperties" in update:
+        grid = update["updateSheetProperties"]["properties"].get("gridProperties", {})
+        sheet["row_count"] = grid.get("rowCount", sheet["row_count"])
@@ -0,0 +1,199 @@
+import sys
+import os
+import json
+import glob
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import importlib
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from transport import Transport, RecordingHandler, ReplayHandler
+
+
+# Stages in the order the workflows run them, so each finds the history it reads
+STAGES = [
+    "id_data",
+    "day_data",
+    "pair_data",
+    "bribe_data",
+    "fee_data",
+    "vote_data",
+    "emissions_data",
+    "revenue_data",
+    "partner_data",
+    "apr_data",
+    "pool_data",
+]
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def fake_credentials():
+    # A throwaway service account; the fakes accept any signed token
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode()
+    return {
+        "type": "service_account",
+        "project_id": "benchmark",
+        "private_key_id": "benchmark",
+        "private_key": pem,
+        "client_email": "benchmark@benchmark.iam.gserviceaccount.com",
+        "client_id": "0",
+        "token_uri": "https://oauth2.googleapis.com/token",
+    }
+
+
+def prepare_workdir():
+    """Copies params and data files into a scratch directory, so runs never touch the checkout."""
+    workdir = tempfile.mkdtemp(prefix="retro-bench-")
+    shutil.copy(os.path.join(ROOT, "params.yaml"), workdir)
+    os.makedirs(os.path.join(workdir, "data"))
+    for path in glob.glob(os.path.join(ROOT, "data", "*.csv")):
+        shutil.copy(path, os.path.join(workdir, "data"))
+    return workdir
+
+
+def run_stages(stages, transport):
+    from retro_utils.context import RunContext
+    from application_logging.logger import logger
+
+    errors = ErrorCounter()
+    logger.addHandler(errors)
+    results = []
+    try:
+        for name in stages:
+            module = importlib.import_module(name)
+            counts = dict(transport.counts)
+            error_count = errors.count
+            tracemalloc.start()
+            started = time.perf_counter()
+            ctx = RunContext()
+            module.run(ctx)
+            ctx.publisher.flush()
+            wall = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            requests = {host: n - counts.get(host, 0) for host, n in transport.counts.items() if n > counts.get(host, 0)}
+            results.append(
+                {
+                    "stage": name,
+                    "wall_s": round(wall, 4),
+                    "requests": sum(requests.values()),
+                    "requests_by_host": requests,
+                    "peak_mb": round(peak / 2 ** 20, 2),
+                    "errors": errors.count - error_count,
+                }
+            )
+    finally:
+        logger.removeHandler(errors)
+    return results
+
+
+def print_table(results, baseline=None):
+    print("%-16s %10s %10s %10s %8s %10s" % ("stage", "wall (s)", "requests", "peak (MB)", "errors", "vs base"))
+    for row in results:
+        change = ""
+        if baseline and row["stage"] in baseline:
+            base_wall = baseline[row["stage"]]["wall_s"]
+            change = "%+.0f%%" % (100 * (row["wall_s"] - base_wall) / base_wall) if base_wall else ""
+        print(
+            "%-16s %10.3f %10d %10.2f %8d %10s"
+            % (row["stage"], row["wall_s"], row["requests"], row["peak_mb"], row["errors"], change)
+        )
+
+
+def regressions(results, baseline, tolerance):
+    """Stages slower, chattier or hungrier than ``baseline`` by more than ``tolerance``."""
+    found = []
+    for row in results:
+        base = baseline.get(row["stage"])
+        if base is None:
+            continue
+        for metric in ["wall_s", "requests", "peak_mb"]:
+            if row[metric] > base[metric] * (1 + tolerance) and row[metric] - base[metric] > 0.01:
+                found.append("%s %s: %s -> %s" % (row["stage"], metric, base[metric], row[metric]))
+        if row["errors"] > base["errors"]:
+            found.append("%s errors: %s -> %s" % (row["stage"], base["errors"], row["errors"]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the stages end to end against recorded or synthetic services")
+    parser.add_argument("stages", nargs="*", help="default: all, in pipeline order")
+    parser.add_argument("--fixtures", help="replay responses recorded in this directory, fakes answer the rest")
+    parser.add_argument("--record", help="run against the live services and record their responses here")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="added to every answer")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against results saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error("unknown stages: %s" % ", ".join(sorted(unknown)))
+
+    fixture_dirs = [os.path.abspath(path) for path in [args.fixtures, args.record] if path]
+    save_path = os.path.abspath(args.save) if args.save else None
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = {row["stage"]: row for row in json.load(baseline_file)}
+
+    workdir = prepare_workdir()
+    os.chdir(workdir)
+    if not args.record:
+        os.environ["RPC"] = "https://rpc.benchmark.invalid/key"
+        os.environ["DUNE"] = "benchmark-dune-key"
+        os.environ["GKEY"] = json.dumps(fake_credentials())
+
+    from retro_utils.context import RunContext
+    import pandas as pd
+    from fakes import FakeServices
+
+    ctx = RunContext()
+    fakes = FakeServices(ctx.config, ctx.ids_df, pd.read_csv("data/partners.csv"))
+    if args.record:
+        handler = RecordingHandler(fixture_dirs[0])
+    elif args.fixtures:
+        handler = ReplayHandler(fixture_dirs[0], fallback=fakes)
+    else:
+        handler = fakes
+
+    try:
+        with Transport(handler, latency=args.latency_ms / 1000) as transport:
+            results = run_stages(args.stages or STAGES, transport)
+    finally:
+        if args.record:
+            handler.save()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_table(results, baseline)
+    if save_path:
+        with open(save_path, "w") as save_file:
+            json.dump(results, save_file, indent=1)
+    if baseline:
+        found = regressions(results, baseline, args.tolerance)
+        for line in found:
+            print("Regression: %s" % line)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
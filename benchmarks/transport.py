@@ -0,0 +1,273 @@
+import io
+import os
+import json
+import time
+import threading
+import collections
+import urllib.error
+import urllib.request
+from urllib.parse import urlparse, parse_qsl, urlencode
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+# Environment variables whose values must never end up in a fixture
+SECRET_ENV = ["RPC", "DUNE"]
+
+# Hosts whose traffic is never recorded (credentials), the fakes always serve them
+UNRECORDED_HOSTS = {"oauth2.googleapis.com", "iamcredentials.googleapis.com"}
+
+
+class Request:
+    def __init__(self, method, url, body):
+        self.method = method.upper()
+        self.url = url
+        if isinstance(body, str):
+            body = body.encode()
+        self.body = body or b""
+        self.host = urlparse(url).netloc
+
+    def json(self):
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+
+class Response:
+    def __init__(self, status, body, headers=None, elapsed=0.0):
+        self.status = status
+        self.body = body if isinstance(body, bytes) else body.encode()
+        self.headers = headers or {}
+        self.elapsed = elapsed
+
+
+class Transport:
+    """Routes every HTTP request of the process to ``handler`` instead of the network.
+
+    Patches ``requests`` (everything but pandas URL reads goes through
+    ``HTTPAdapter.send``: price API, subgraph, RPC, Dune and gspread) and
+    ``urllib.request.urlopen`` (``pd.read_csv(url)``). ``handler`` takes a
+    ``Request`` and a ``forward`` function that performs it for real, and returns
+    a ``Response``. Requests are counted per host. ``latency`` seconds are added
+    to every answer to make waiting on the network part of the measurement.
+    """
+
+    def __init__(self, handler, latency=0.0):
+        self.handler = handler
+        self.latency = latency
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._send = HTTPAdapter.send
+        self._urlopen = urllib.request.urlopen
+        transport = self
+
+        def send(adapter, prepared, **kwargs):
+            request = Request(prepared.method, prepared.url, prepared.body)
+
+            def forward(request):
+                started = time.perf_counter()
+                response = transport._send(adapter, prepared, **kwargs)
+                return Response(
+                    response.status_code,
+                    response.content,
+                    {"Content-Type": response.headers.get("Content-Type", "")},
+                    time.perf_counter() - started,
+                )
+
+            answer = transport._handle(request, forward)
+            response = requests.Response()
+            response.status_code = answer.status
+            response._content = answer.body
+            response.headers = CaseInsensitiveDict(answer.headers)
+            response.url = prepared.url
+            response.request = prepared
+            response.encoding = "utf-8"
+            response.reason = "OK" if answer.status < 400 else "Error"
+            return response
+
+        def urlopen(url, *args, **kwargs):
+            if isinstance(url, urllib.request.Request):
+                request = Request(url.get_method(), url.full_url, url.data)
+            else:
+                request = Request("GET", url, None)
+
+            def forward(request):
+                started = time.perf_counter()
+                with transport._urlopen(request.url, *args, **kwargs) as response:
+                    body = response.read()
+                    content_type = response.headers.get("Content-Type", "")
+                return Response(200, body, {"Content-Type": content_type}, time.perf_counter() - started)
+
+            answer = transport._handle(request, forward)
+            if answer.status >= 400:
+                raise urllib.error.HTTPError(request.url, answer.status, "Error", answer.headers, io.BytesIO(answer.body))
+            response = io.BytesIO(answer.body)
+            response.headers = answer.headers
+            response.status = answer.status
+            return response
+
+        HTTPAdapter.send = send
+        urllib.request.urlopen = urlopen
+        return self
+
+    def __exit__(self, *exc_info):
+        HTTPAdapter.send = self._send
+        urllib.request.urlopen = self._urlopen
+
+    def _handle(self, request, forward):
+        with self._lock:
+            self.counts[request.host] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self.handler(request, forward)
+
+
+def redact(text):
+    for name in SECRET_ENV:
+        value = os.environ.get(name)
+        if value:
+            text = text.replace(value, "$" + name)
+    return text
+
+
+def request_keys(request):
+    """Exact and loose fixture keys of a request.
+
+    The exact key covers method, URL and body, with JSON-RPC ids left out as they
+    depend on call order. The loose key only keeps what decides the shape of the
+    answer (endpoint, RPC method, contract, selector and calldata size), so a
+    replay still finds an answer when timestamps in the request have moved on
+    since recording.
+    """
+    parsed = urlparse(redact(request.url))
+    query = urlencode(sorted(parse_qsl(parsed.query)))
+    endpoint = "%s %s%s" % (request.method, parsed.netloc, parsed.path)
+    body = request.json()
+    if _is_json_rpc(body):
+        calls = body if isinstance(body, list) else [body]
+        exact = json.dumps([[call.get("method"), call.get("params")] for call in calls], sort_keys=True)
+        loose = json.dumps([_rpc_shape(call) for call in calls])
+    else:
+        exact = redact(request.body.decode("utf-8", "replace"))
+        loose = ""
+    return "%s?%s %s" % (endpoint, query, exact), "%s %s" % (endpoint, loose)
+
+
+class RecordingHandler:
+    """Performs requests for real and keeps their responses as fixtures, one file per host."""
+
+    def __init__(self, fixture_dir):
+        self.fixture_dir = fixture_dir
+        self.fixtures = collections.defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def __call__(self, request, forward):
+        response = forward(request)
+        if request.host in UNRECORDED_HOSTS:
+            return response
+        exact, loose = request_keys(request)
+        with self._lock:
+            entry = self.fixtures[request.host].setdefault(
+                exact, {"loose": loose, "request_ids": _rpc_ids(request.json()), "responses": []}
+            )
+            entry["responses"].append(
+                {
+                    "status": response.status,
+                    "headers": response.headers,
+                    "body": redact(response.body.decode("utf-8", "replace")),
+                    "elapsed": response.elapsed,
+                }
+            )
+        return response
+
+    def save(self):
+        os.makedirs(self.fixture_dir, exist_ok=True)
+        for host, entries in self.fixtures.items():
+            with open(os.path.join(self.fixture_dir, host + ".json"), "w") as fixture_file:
+                json.dump(entries, fixture_file, indent=1, sort_keys=True)
+
+
+class ReplayHandler:
+    """Answers requests from recorded fixtures, ``fallback`` (e.g. the fakes) when none match.
+
+    A key recorded several times (polling, pagination) replays its responses in
+    order and then keeps repeating the last one. ``latency`` replays the recorded
+    response times. JSON-RPC ids in the answers are rewritten to the request's.
+    """
+
+    def __init__(self, fixture_dir, fallback=None, latency=False):
+        self.fallback = fallback
+        self.latency = latency
+        self.exact = {}
+        self.loose = collections.defaultdict(list)
+        self.positions = collections.Counter()
+        self._lock = threading.Lock()
+        for name in sorted(os.listdir(fixture_dir)) if os.path.isdir(fixture_dir) else []:
+            with open(os.path.join(fixture_dir, name)) as fixture_file:
+                for exact, entry in json.load(fixture_file).items():
+                    self.exact[exact] = entry
+                    self.loose[entry["loose"]].extend((entry, response) for response in entry["responses"])
+
+    def __call__(self, request, forward):
+        exact, loose = request_keys(request)
+        with self._lock:
+            if exact in self.exact:
+                entry = self.exact[exact]
+                position = self.positions[exact]
+                self.positions[exact] += 1
+                recorded = entry["responses"][min(position, len(entry["responses"]) - 1)]
+            elif self.loose.get(loose):
+                position = self.positions[loose]
+                self.positions[loose] += 1
+                entry, recorded = self.loose[loose][position % len(self.loose[loose])]
+            else:
+                entry = recorded = None
+
+        if recorded is None:
+            if self.fallback is None:
+                raise requests.ConnectionError("No fixture for %s %s" % (request.method, redact(request.url)))
+            return self.fallback(request, forward)
+        if self.latency:
+            time.sleep(recorded["elapsed"])
+        body = _rewrite_rpc_ids(recorded["body"], entry["request_ids"], _rpc_ids(request.json()))
+        return Response(recorded["status"], body, recorded["headers"], recorded["elapsed"])
+
+
+def _is_json_rpc(body):
+    calls = body if isinstance(body, list) else [body]
+    return bool(calls) and all(isinstance(call, dict) and "jsonrpc" in call for call in calls)
+
+
+def _rpc_shape(call):
+    params = call.get("params") or []
+    if call.get("method") == "eth_call" and params and isinstance(params[0], dict):
+        data = params[0].get("data", "")
+        # Same contract, function and calldata size: an answer that decodes the same way
+        return [call["method"], params[0].get("to", "").lower(), data[:10], len(data)]
+    return [call.get("method")]
+
+
+def _rpc_ids(body):
+    if not _is_json_rpc(body):
+        return None
+    calls = body if isinstance(body, list) else [body]
+    return [call.get("id") for call in calls]
+
+
+def _rewrite_rpc_ids(body, recorded_ids, request_ids):
+    if not recorded_ids or not request_ids:
+        return body
+    try:
+        answer = json.loads(body)
+    except ValueError:
+        return body
+    mapping = dict(zip(recorded_ids, request_ids))
+    items = answer if isinstance(answer, list) else [answer]
+    for item in items:
+        if isinstance(item, dict) and item.get("id") in mapping:
+            item["id"] = mapping[item["id"]]
+    return json.dumps(answer)
@@ -1,73 +1,63 @@
-import requests
 import pandas as pd
-import yaml
-import json
-import os
+import copy
 from datetime import datetime, timezone, timedelta
 from application_logging.logger import logger
-import gspread
+from application_logging.instrumentation import stage, report
+from retro_utils.subgraph import paginate
+from retro_utils.context import RunContext
 
 
-# Params
-params_path = "params.yaml"
+@stage("day_data")
+def run(ctx):
+    config = ctx.config
 
-def read_params(config_path):
-    with open(config_path) as yaml_file:
-        config = yaml.safe_load(yaml_file)
-    return config
+    # Fusion   
+    try:
+        logger.info("Day Data Fusion Started")
 
-config = read_params(params_path)
-
-
-# Fusion   
-try:
-    logger.info("Day Data Fusion Started")
-
-    # Params Data
-    subgraph = config["query"]["fusion_subgraph"]
-    day_data_fusion_query = config["query"]["day_data_fusion_query"]
-    daily_data_fusion_csv = config["files"]["daily_data_fusion"]
+        # Params Data
+        subgraph = config["query"]["fusion_subgraph"]
+        day_data_fusion_query = copy.deepcopy(config["query"]["day_data_fusion_query"])
     
-    # Date Stuff
-    todayDate = datetime.utcnow()
-    twodayago = todayDate - timedelta(2)
-    my_time = datetime.min.time()
-    my_datetime = datetime.combine(twodayago, my_time)
-    timestamp = int(my_datetime.replace(tzinfo=timezone.utc).timestamp())
+        # Date Stuff
+        todayDate = datetime.utcnow()
+        twodayago = todayDate - timedelta(2)
+        my_time = datetime.min.time()
+        my_datetime = datetime.combine(twodayago, my_time)
+        timestamp = int(my_datetime.replace(tzinfo=timezone.utc).timestamp())
     
-    # Request
-    day_data_fusion_query["variables"]["startTime"] = timestamp
-    response = requests.post(url=subgraph, json=day_data_fusion_query)
-    data = response.json()["data"]["uniswapDayDatas"]
-    day_data_fusion_df = pd.DataFrame(data)
-    day_data_fusion_df["date"] = day_data_fusion_df["date"].apply(lambda timestamp: datetime.utcfromtimestamp(timestamp).date())
-    day_data_fusion_df["date"] = day_data_fusion_df["date"].apply(lambda date: datetime.strftime(date, "%Y-%m-%d"))
-
-    day_data_fusion_old = pd.read_csv(daily_data_fusion_csv)
-    drop_index = day_data_fusion_old[day_data_fusion_old['date']>datetime.fromtimestamp(timestamp).strftime(format='%Y-%m-%d')].index
-    index_list = drop_index.to_list()
-    index_list = list(map(lambda x: x + 2, index_list))
-    day_data_fusion_df['__typename'] = 'Fusion'
-    day_data_fusion_df = day_data_fusion_df.astype({'id':'int','volumeUSD':'float', 'feesUSD':'float',	'tvlUSD':'float'})
-    df_values = day_data_fusion_df.values.tolist()
+        # Request
+        day_data_fusion_query["variables"]["startTime"] = timestamp
+        data = paginate(
+            subgraph,
+            day_data_fusion_query,
+            entity="uniswapDayDatas",
+            cursor_variable="startTime",
+            cursor_field="date",
+            page_size=config["query"]["subgraph_page_size"],
+        )
+        day_data_fusion_df = pd.DataFrame(data)
+        day_data_fusion_df["date"] = day_data_fusion_df["date"].apply(lambda timestamp: datetime.utcfromtimestamp(timestamp).date())
+        day_data_fusion_df["date"] = day_data_fusion_df["date"].apply(lambda date: datetime.strftime(date, "%Y-%m-%d"))
+
+        cutoff_date = datetime.fromtimestamp(timestamp).strftime(format='%Y-%m-%d')
+        day_data_fusion_df['__typename'] = 'Fusion'
+        day_data_fusion_df = day_data_fusion_df.astype({'id':'int','volumeUSD':'float', 'feesUSD':'float',	'tvlUSD':'float'})
     
-    # Write to GSheets
-    credentials = os.environ["GKEY"]
-    credentials = json.loads(credentials)
-    gc = gspread.service_account_from_dict(credentials)
+        # Store rows after the cutoff
+        ctx.store.write("daily_data_fusion", day_data_fusion_df, replace={"date": (">", cutoff_date)})
 
-    # Open a google sheet
-    sheetkey = config["gsheets"]["daily_data_fusion_sheet_key"]
-    gs = gc.open_by_key(sheetkey)
+        # Queue GSheets sync
+        sheetkey = config["gsheets"]["daily_data_fusion_sheet_key"]
+        ctx.publisher.sync(sheetkey, "Master", day_data_fusion_df, ["date"], lambda keys: keys["date"] > cutoff_date)
 
-    # Select a work sheet from its name
-    worksheet1 = gs.worksheet("Master")
-    if index_list != []:
-        worksheet1.delete_rows(index_list[0], index_list[-1])
+        logger.info("Day Data Fusion Ended")
+    except Exception as e:
+        logger.error("Error occurred during Day Data Fusion process. Error: %s" % e, exc_info=True)
 
-    # Append to Worksheet
-    gs.values_append("Master", {"valueInputOption": "USER_ENTERED"}, {"values": df_values})
 
-    logger.info("Day Data Fusion Ended")
-except Exception as e:
-    logger.error("Error occurred during Day Data Fusion process. Error: %s" % e, exc_info=True)
\ No newline at end of file
+if __name__ == "__main__":
+    ctx = RunContext()
+    run(ctx)
+    ctx.publisher.flush()
+    report()
@@ -1,123 +1,62 @@
-import requests
 import pandas as pd
-import yaml
-import json
-import os
-from datetime import datetime, timezone
-from dateutil.relativedelta import relativedelta, TH
 from application_logging.logger import logger
-import gspread
-from web3 import Web3
-from web3.middleware import validation
+from application_logging.instrumentation import stage, span, report
+from retro_utils.multicall import Multicall, fetch_reward_data
+from retro_utils.rpc_batch import RPCBatch
+from retro_utils.amounts import normalize_amounts
+from retro_utils.epochs import epoch_of
+from retro_utils.abis import load_functions
+from retro_utils.context import RunContext
 
 
-# Params
-params_path = "params.yaml"
+@span("fetch")
+def fetch_fees(ctx, ids_df, timestamp):
+    """Reads the rewards of each gauge's fee contract for the epoch ending at ``timestamp``."""
+    config = ctx.config
 
-
-def read_params(config_path):
-    with open(config_path) as yaml_file:
-        config = yaml.safe_load(yaml_file)
-    return config
-
-
-config = read_params(params_path)
-
-try:
     # Params Data
-    id_data = config["files"]["id_data"]
     provider_url = config["web3"]["provider_url"]
-    bribe_abi = config["web3"]["bribe_abi"]
-    epoch_csv = config["files"]["epoch_data"]
-    price_api = config["api"]["price_api"]
-    fee_csv = config["files"]["fee_data"]
-
-    # Pulling Fee Data
-    logger.info("Fee Data Started")
-
-    ids_df = pd.read_csv(id_data)
-
-    # Get Epoch Timestamp
-    todayDate = datetime.utcnow()
-    if todayDate.isoweekday() == 4 and todayDate.hour > 1:
-        nextThursday = todayDate + relativedelta(weekday=TH(2))
-        my_time = datetime.min.time()
-        my_datetime = datetime.combine(nextThursday, my_time)
-        timestamp = int(my_datetime.replace(tzinfo=timezone.utc).timestamp())
-        print("Yes, The next Thursday date:", my_datetime, timestamp)
-    else:
-        nextThursday = todayDate + relativedelta(weekday=TH(0))
-        my_time = datetime.min.time()
-        my_datetime = datetime.combine(nextThursday, my_time)
-        timestamp = int(my_datetime.replace(tzinfo=timezone.utc).timestamp())
-        print("No, The next Thursday date:", my_datetime, timestamp)
-
-    # Read Epoch Data
-    epoch_data = pd.read_csv(epoch_csv)
-    epoch = epoch_data[epoch_data["timestamp"] == timestamp]["epoch"].values[0] - 1
+    bribe_functions = load_functions("bribe")
 
     # Pull Fees Web3
-    validation.METHODS_TO_VALIDATE = []
-    w3 = Web3(Web3.HTTPProvider(provider_url, request_kwargs={"timeout": 60}))
+    rpc_batch = RPCBatch(
+        ctx.provider_pool(provider_url), chunk_size=config["web3"]["rpc_batch_size"], timeout=60
+    )
+    multicall = Multicall(
+        rpc_batch,
+        config["web3"]["multicall_ca"],
+        config["web3"]["multicall_batch_size"],
+    )
+
+    fee_ids_df = ids_df[ids_df["gauge.fee"] != "0x0000000000000000000000000000000000000000"]
+    rewards = fetch_reward_data(multicall, fee_ids_df["gauge.fee"], bribe_functions, timestamp, ctx.store)
 
     fees_list = []
-    for name, fee_ca in zip(ids_df["symbol"], ids_df["gauge.fee"]):
-        if fee_ca == "0x0000000000000000000000000000000000000000":
-            pass
-        else:
-            contract_address = fee_ca
-            contract_instance = w3.eth.contract(address=contract_address, abi=bribe_abi)
-
-            rewardsListLength = contract_instance.functions.rewardsListLength().call()
-
-            rewardTokens = []
-            for reward_num in range(rewardsListLength):
-                rewardTokens.append(
-                    contract_instance.functions.rewardTokens(reward_num).call()
+    for name, pool_rewards in zip(fee_ids_df["symbol"], rewards):
+        for reward_addy, rewarddata in pool_rewards:
+            if rewarddata[1] > 0:
+                fees_list.append(
+                    {"name": name, "fees": rewarddata[1], "address": reward_addy}
                 )
 
-            for reward_addy in rewardTokens:
-                rewarddata = contract_instance.functions.rewardData(
-                    reward_addy, timestamp
-                ).call()
-                if rewarddata[1] > 0:
-                    fees_list.append(
-                        {"name": name, "fees": rewarddata[1], "address": reward_addy}
-                    )
-
-    fee_df = pd.DataFrame(fees_list)
-    if fee_df.empty:
-        raise Exception("Fee DF is Empty.")
-    fee_df["address"] = fee_df["address"].apply(str.lower)
+    return pd.DataFrame(fees_list)
 
-    # Pull Prices
-    response = requests.get(price_api)
-    pricelist = []
-    for i in response.json()["data"]:
-        pricelist.append([i["name"], i["address"], i["price"], i["decimals"]])
 
-    price_df = pd.DataFrame(pricelist, columns=["name", "address", "price", "decimals"])
+@span("build")
+def fee_amounts(fee_df, prices, epoch):
+    """Values the raw fees of ``fetch_fees`` and shapes them into ``epoch``'s rows."""
+    fee_df["address"] = fee_df["address"].apply(str.lower)
 
     # Fee Amounts
-    fee_df = fee_df.merge(
-        price_df[["name", "address", "price", "decimals"]], on="address", how="left"
-    )
+    fee_df = prices.join(fee_df, left_on="address")
     null_data = fee_df[fee_df.isnull().any(axis=1)]
     if not null_data.empty:
         logger.error("Null Data. Error: %s" % null_data)
 
     fee_df = fee_df.dropna(axis=0)
     fee_df.reset_index(drop=True, inplace=True)
-    fee_df["fee_amount"] = fee_df["price"] * fee_df["fees"]
     fee_df["decimals"] = fee_df["decimals"].astype(int)
-
-    fee_amount = []
-    for dec, amt in zip(fee_df["decimals"], fee_df["fee_amount"]):
-        decimal = "1"
-        decimal = decimal.ljust(dec + 1, "0")
-        fee_amount.append((amt / int(decimal)))
-
-    fee_df["fee_amount"] = fee_amount
+    fee_df["fee_amount"] = fee_df["price"] * normalize_amounts(fee_df["fees"], fee_df["decimals"])
     fee_df["epoch"] = epoch
     fee_df.drop(["fees", "decimals"], axis=1, inplace=True)
     fee_df.columns = [
@@ -128,32 +67,47 @@ try:
         "fee_amount",
         "epoch",
     ]
-    print(fee_df)
-
-    # Rewriting current Epoch's Fee Data
-    feeor = pd.read_csv(fee_csv)
-    drop_index = feeor[feeor["epoch"] == epoch].index
-    index_list = drop_index.to_list()
-    index_list = list(map(lambda x: x + 2, index_list))
-    df_values = fee_df.values.tolist()
-
-    # Write to GSheets
-    credentials = os.environ["GKEY"]
-    credentials = json.loads(credentials)
-    gc = gspread.service_account_from_dict(credentials)
-
-    # Open a google sheet
-    sheetkey = config["gsheets"]["fee_data_sheet_key"]
-    gs = gc.open_by_key(sheetkey)
-
-    # Select a work sheet from its name
-    worksheet1 = gs.worksheet("Master")
-    if index_list != []:
-        worksheet1.delete_rows(index_list[0], index_list[-1])
-        
-    # Append to Worksheet
-    gs.values_append("Master", {"valueInputOption": "USER_ENTERED"}, {"values": df_values})
-
-    logger.info("Fee Data Ended")
-except Exception as e:
-    logger.error("Error occurred during Fee Data process. Error: %s" % e, exc_info=True)
\ No newline at end of file
+    return fee_df
+
+
+@stage("fee_data")
+def run(ctx):
+    config = ctx.config
+
+    try:
+        # Pulling Fee Data
+        logger.info("Fee Data Started")
+
+        ids_df = ctx.ids_df
+
+        # Get Epoch Timestamp
+        timestamp = ctx.epoch_timestamp
+
+        # Get Epoch
+        epoch = epoch_of(timestamp) - 1
+
+        fee_df = fetch_fees(ctx, ids_df, timestamp)
+        if fee_df.empty:
+            raise Exception("Fee DF is Empty.")
+
+        # Pull Prices
+        fee_df = fee_amounts(fee_df, ctx.prices, epoch)
+        print(fee_df)
+
+        # Store current Epoch's rows
+        ctx.store.write("fee_data", fee_df, replace={"epoch": epoch})
+
+        # Queue GSheets sync
+        sheetkey = config["gsheets"]["fee_data_sheet_key"]
+        ctx.publisher.sync(sheetkey, "Master", fee_df, ["epoch", "name_pool", "address"], lambda keys: keys["epoch"] == str(epoch))
+
+        logger.info("Fee Data Ended")
+    except Exception as e:
+        logger.error("Error occurred during Fee Data process. Error: %s" % e, exc_info=True)
+
+
+if __name__ == "__main__":
+    ctx = RunContext()
+    run(ctx)
+    ctx.publisher.flush()
+    report()
@@ -1,33 +1,32 @@
 import requests
 import pandas as pd
-import yaml
 from application_logging.logger import logger
+from application_logging.instrumentation import stage, report, count_response
+from retro_utils.context import RunContext
 
 
-# Params
-params_path = "params.yaml"
+@stage("id_data")
+def run(ctx):
+    config = ctx.config
 
+    try:
+        logger.info("ID Data Started")
 
-def read_params(config_path):
-    with open(config_path) as yaml_file:
-        config = yaml.safe_load(yaml_file)
-    return config
+        # Params Data
+        fusion_api = config["api"]["fusion_api"]
 
+        # Request
+        response = requests.get(url=fusion_api)
+        count_response("fusion_api", response)
+        data = response.json()["data"]
+        ids_df = pd.json_normalize(response.json()['data'])[['symbol', 'address', 'isGamma', 'feeLevel', 'underlyingPool', 'type', 'gauge.address', 'gauge.fee', 'gauge.bribe']]
+        ids_df.to_csv("data/ids_data.csv", index=False)
 
-config = read_params(params_path)
+        logger.info("ID Data Ended")
+    except Exception as e:
+        logger.error("Error occurred during ID Data process. Error: %s" % e, exc_info=True)
 
-try:
-    logger.info("ID Data Started")
 
-    # Params Data
-    fusion_api = config["api"]["fusion_api"]
-
-    # Request
-    response = requests.get(url=fusion_api)
-    data = response.json()["data"]
-    ids_df = pd.json_normalize(response.json()['data'])[['symbol', 'address', 'isGamma', 'feeLevel', 'underlyingPool', 'type', 'gauge.address', 'gauge.fee', 'gauge.bribe']]
-    ids_df.to_csv("data/ids_data.csv", index=False)
-
-    logger.info("ID Data Ended")
-except Exception as e:
-    logger.error("Error occurred during ID Data process. Error: %s" % e, exc_info=True)
+if __name__ == "__main__":
+    run(RunContext())
+    report()
@@ -1,103 +1,229 @@
-import requests
+import argparse
 import pandas as pd
-import yaml
-import json
-import os
+import copy
 from datetime import datetime, timezone, timedelta
 from application_logging.logger import logger
-import gspread
-from web3 import Web3
-from web3.middleware import validation
+from application_logging.instrumentation import stage, span, count, report
+from retro_utils.subgraph import fetch_concurrent, iter_pages
+from retro_utils.epochs import epoch_of
+from retro_utils.context import RunContext
+import revenue_data
 
 
-# Params
-params_path = "params.yaml"
+# Columns of the pair_data_fusion history, in sheet order
+PAIR_COLUMNS = ['id', 'date', 'tvlUSD', 'volumeUSD', 'volumeToken0', 'volumeToken1', 'token0Price', 'token1Price', 'feesUSD', '__typename', 'name', 'underlyingPool', 'type', 'epoch']
+FLOAT_COLUMNS = ['tvlUSD', 'volumeUSD', 'volumeToken0', 'volumeToken1', 'token0Price', 'token1Price', 'feesUSD']
 
-def read_params(config_path):
-    with open(config_path) as yaml_file:
-        config = yaml.safe_load(yaml_file)
-    return config
+# Rows per store write when streaming a backfill
+STREAM_CHUNK_SIZE = 5000
 
-config = read_params(params_path)
+# Store table a backfill streams into, swapped in once complete
+STAGING_TABLE = "pair_data_fusion_staging"
 
 
-# Fusion
-try:
-    # Params Data
-    subgraph = config["query"]["fusion_subgraph"]
-    id_data = config["files"]["id_data"]
+def pair_queries(config, pools, timestamp):
+    """One poolDayDatas query per chunk of ``pools``, for the days after ``timestamp``."""
     pair_data_fusion_query = config["query"]["pair_data_fusion_query"]
-    epoch_daily_csv = config["files"]["epoch_daily_data"]
-    pair_data_fusion_csv = config["files"]["pair_data_fusion"]
-    provider_url = config["web3"]["provider_url"]
-
-    # Pulling Pair Data
-    logger.info("Pair Data Fusion Started")
-
-    # Request and Edit Pair Data
-    ids_df = pd.read_csv(id_data)
+    pools_per_query = config["query"]["pools_per_query"]
+
+    pool_chunks = [pools[i : i + pools_per_query] for i in range(0, len(pools), pools_per_query)]
+    queries = []
+    for pool_chunk in pool_chunks:
+        query = copy.deepcopy(pair_data_fusion_query)
+        query["variables"]["pairAddresses"] = pool_chunk
+        query["variables"]["startTime"] = timestamp
+        queries.append(query)
+    return pool_chunks, queries
+
+
+def pool_frames(ids_df):
+    # Pool id -> name, and name -> the pool's ids row columns
+    pool_names = pd.DataFrame({"pool.id": ids_df["underlyingPool"].str.lower(), "name": ids_df["symbol"]})
+    pool_types = ids_df[["symbol", "underlyingPool", "type"]]
+    return pool_names, pool_types
+
+
+def normalize(pages, pool_names, pool_types):
+    """Flattens pages of poolDayDatas rows into frames, with each pool's name and type."""
+    for page in pages:
+        df = pd.json_normalize(page)
+        df = pd.merge(df, pool_names, how="inner", on="pool.id")
+        df = pd.merge(df, pool_types, how="left", left_on="name", right_on="symbol")
+        df.drop("symbol", axis=1, inplace=True)
+        yield df
+
+
+def attach_epoch(frames):
+    """Turns the unix ``date`` of each row into its day (``%Y-%m-%d``) and adds the day's epoch."""
+    for df in frames:
+        day = df["date"].astype("int64") // 86400 * 86400
+        df["epoch"] = epoch_of(day.values)
+        df["date"] = pd.to_datetime(day, unit="s").dt.strftime("%Y-%m-%d")
+        yield df
+
+
+def cast_types(frames):
+    """Shapes frames into history rows: sheet column order, typed numbers."""
+    for df in frames:
+        df['__typename'] = 'Fusion'
+        yield df[PAIR_COLUMNS].astype({column: 'float' for column in FLOAT_COLUMNS})
+
+
+def rechunk(frames, chunk_size):
+    """Regroups frames of any size into frames of ``chunk_size`` rows (the last may be shorter)."""
+    pending = []
+    pending_rows = 0
+    for df in frames:
+        pending.append(df)
+        pending_rows += len(df)
+        while pending_rows >= chunk_size:
+            merged = pd.concat(pending, ignore_index=True)
+            yield merged.iloc[:chunk_size]
+            pending = [merged.iloc[chunk_size:]]
+            pending_rows = len(pending[0])
+    if pending_rows:
+        yield pd.concat(pending, ignore_index=True)
+
+
+@span("stream")
+def stream_history(ctx, timestamp, chunk_size=STREAM_CHUNK_SIZE, publish=True):
+    """Rebuilds the stored pair history after ``timestamp`` with memory bounded by ``chunk_size``.
+
+    Subgraph pages are requested one at a time and flow through normalize,
+    attach_epoch and cast_types into store writes of ``chunk_size`` rows, so
+    nothing holds more than a page and a chunk, however long the history is.
+    Chunks go to a staging table that replaces the stored rows after the
+    cutoff only once the last page is in, so a stream that fails partway
+    leaves the history as it was. Revenue of the cutoff's epoch on is then
+    rebuilt from the new history. With ``publish`` the streamed dates and the
+    rebuilt revenue are synced to their sheets, which paste them in
+    ``publish.chunk_rows`` chunks. Returns the number of rows.
+    """
+    config = ctx.config
+    subgraph = config["query"]["fusion_subgraph"]
+    subgraph_retries = config["query"]["subgraph_retries"]
+    subgraph_page_size = config["query"]["subgraph_page_size"]
+
+    ids_df = ctx.ids_df
+    pool_names, pool_types = pool_frames(ids_df)
+    _, queries = pair_queries(config, pool_names["pool.id"].unique().tolist(), timestamp)
+
+    pages = (
+        page
+        for query in queries
+        for page in iter_pages(subgraph, query, "poolDayDatas", "lastId", "id", subgraph_page_size, subgraph_retries)
+    )
+    chunks = rechunk(cast_types(attach_epoch(normalize(pages, pool_names, pool_types))), chunk_size)
+
+    cutoff_date = datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d')
+    # Leftovers of an earlier stream that failed
+    ctx.store.drop(STAGING_TABLE)
+    rows = 0
+    for chunk in chunks:
+        ctx.store.write(STAGING_TABLE, chunk)
+        rows += len(chunk)
+        count("pair_data.rows_streamed", len(chunk))
+    logger.info("Pair Data Fusion streamed %s rows after %s" % (rows, cutoff_date))
+    if not rows:
+        return rows
+    ctx.store.swap_in(STAGING_TABLE, "pair_data_fusion", replace={"date": (">", cutoff_date)})
+
+    # Revenue Rebuild
+    first_epoch = epoch_of(timestamp)
+    revenue_df = revenue_data.build_from(ctx.store, first_epoch)
+    ctx.store.write("revenue_data", revenue_df, replace={"epoch": (">=", first_epoch)})
+    logger.info("Pair Data Fusion: rebuilt %s revenue rows from epoch %s" % (len(revenue_df), first_epoch))
+
+    if publish:
+        ctx.publisher.sync(
+            config["gsheets"]["pair_data_fusion_sheet_key"],
+            "Master",
+            ctx.store.read("pair_data_fusion", where={"date": (">", cutoff_date)}),
+            ["date", "id", "name"],
+            lambda keys: keys["date"] > cutoff_date,
+        )
+        ctx.publisher.sync(
+            config["gsheets"]["revenue_data_sheet_key"],
+            "Master",
+            revenue_df,
+            ["epoch", "name_pool"],
+            lambda keys: pd.to_numeric(keys["epoch"], errors="coerce") >= first_epoch,
+        )
+        ctx.publisher.flush()
+    return rows
+
+
+@stage("pair_data")
+def run(ctx):
+    config = ctx.config
+
+    # Fusion
+    try:
+        # Params Data
+        subgraph = config["query"]["fusion_subgraph"]
+        subgraph_max_workers = config["query"]["subgraph_max_workers"]
+        subgraph_retries = config["query"]["subgraph_retries"]
+        subgraph_page_size = config["query"]["subgraph_page_size"]
+
+        # Pulling Pair Data
+        logger.info("Pair Data Fusion Started")
+
+        # Request and Edit Pair Data
+        ids_df = ctx.ids_df
     
-    # Today and 2 Day Ago
-    todayDate = datetime.utcnow()
-    twodayago = todayDate - timedelta(2)
-    my_time = datetime.min.time()
-    my_datetime = datetime.combine(twodayago, my_time)
-    timestamp = int(my_datetime.replace(tzinfo=timezone.utc).timestamp())
-
-    # Web3
-    validation.METHODS_TO_VALIDATE = []
-    w3 = Web3(Web3.HTTPProvider(provider_url, request_kwargs={"timeout": 60}))
-
-    pairdata_fusion_df = pd.DataFrame()
-    for name, contract_address in zip(ids_df["symbol"], ids_df["underlyingPool"]):
-        try:
-            pair_data_fusion_query["variables"]["pairAddress"] = contract_address.lower()
-            pair_data_fusion_query["variables"]["startTime"] = timestamp
-            response = requests.post(subgraph, json=pair_data_fusion_query, timeout=60)
-            data = response.json()["data"]["poolDayDatas"]
-            df = pd.json_normalize(data)
-            df["name"] = name
-            pairdata_fusion_df = pd.concat([pairdata_fusion_df, df], axis=0, ignore_index=True)
-            pairdata_fusion_df.reset_index(drop=True, inplace=True)
-        except Exception as e:
-            logger.error("Error occurred during Pair Data Fusion process. Pair: %s, Address: %s, Error: %s" % (name, contract_address, e))
-
-    epoch_data = pd.read_csv(epoch_daily_csv)
-    epoch_data["date"] = epoch_data["date"].apply(lambda date: datetime.strptime(date, "%d-%m-%Y").date())
-
-    pairdata_fusion_df["date"] = pairdata_fusion_df["date"].apply(lambda timestamp: datetime.utcfromtimestamp(timestamp).date())
-    pairdata_fusion_df = pd.merge(pairdata_fusion_df, ids_df[["symbol", "underlyingPool", "type"]], how="left", left_on="name", right_on="symbol")
-    pairdata_fusion_df.drop("symbol", axis=1, inplace=True)
-    pairdata_fusion_df = pd.merge(pairdata_fusion_df, epoch_data[["date", "epoch"]], how="left", on="date")
-    pairdata_fusion_df.sort_values("date", ascending=True, inplace=True)
-    pairdata_fusion_df["date"] = pairdata_fusion_df["date"].apply(lambda date: datetime.strftime(date, "%Y-%m-%d"))
-
-    pairdata_fusion_old = pd.read_csv(pair_data_fusion_csv)
-    drop_index = pairdata_fusion_old[pairdata_fusion_old['date']>datetime.fromtimestamp(timestamp).strftime(format='%Y-%m-%d')].index
-    index_list = drop_index.to_list()
-    index_list = list(map(lambda x: x + 2, index_list))
-    pairdata_fusion_df['__typename'] = 'Fusion'
-    pairdata_fusion_df = pairdata_fusion_df[['id', 'date', 'tvlUSD', 'volumeUSD', 'volumeToken0', 'volumeToken1', 'token0Price', 'token1Price', 'feesUSD', '__typename', 'name', 'underlyingPool', 'type', 'epoch']]
-    pairdata_fusion_df = pairdata_fusion_df.astype({'tvlUSD':'float', 'volumeUSD':'float', 'volumeToken0':'float', 'volumeToken1':'float', 'token0Price':'float', 'token1Price':'float', 'feesUSD':'float'})
-    df_values = pairdata_fusion_df.values.tolist()
-
-    # Write to GSheets
-    credentials = os.environ["GKEY"]
-    credentials = json.loads(credentials)
-    gc = gspread.service_account_from_dict(credentials)
-
-    # Open a google sheet
-    sheetkey = config["gsheets"]["pair_data_fusion_sheet_key"]
-    gs = gc.open_by_key(sheetkey)
-
-    # Select a work sheet from its name
-    worksheet1 = gs.worksheet("Master")
-    if index_list != []:
-        worksheet1.delete_rows(index_list[0], index_list[-1])
-
-    # Append to Worksheet
-    gs.values_append("Master", {"valueInputOption": "USER_ENTERED"}, {"values": df_values})
-
-    logger.info("Pair Data Fusion Ended")
-except Exception as e:
-    logger.error("Error occurred during Pair Data Fusion process. Error: %s" % e, exc_info=True)
\ No newline at end of file
+        # Today and 2 Day Ago
+        todayDate = datetime.utcnow()
+        twodayago = todayDate - timedelta(2)
+        my_time = datetime.min.time()
+        my_datetime = datetime.combine(twodayago, my_time)
+        timestamp = int(my_datetime.replace(tzinfo=timezone.utc).timestamp())
+
+        pool_names, pool_types = pool_frames(ids_df)
+        pool_chunks, queries = pair_queries(config, pool_names["pool.id"].unique().tolist(), timestamp)
+        pagination = {"entity": "poolDayDatas", "cursor_variable": "lastId", "cursor_field": "id", "page_size": subgraph_page_size}
+        results = fetch_concurrent(subgraph, queries, max_workers=subgraph_max_workers, retries=subgraph_retries, pagination=pagination)
+
+        pair_rows = []
+        for pool_chunk, result in zip(pool_chunks, results):
+            if isinstance(result, Exception):
+                for _, row in pool_names[pool_names["pool.id"].isin(pool_chunk)].iterrows():
+                    logger.error("Error occurred during Pair Data Fusion process. Pair: %s, Address: %s, Error: %s" % (row["name"], row["pool.id"], result))
+                continue
+            pair_rows.extend(result)
+
+        # Same steps as a streamed backfill, on the one page of recent rows
+        pairdata_fusion_df = next(cast_types(attach_epoch(normalize([pair_rows], pool_names, pool_types))))
+        pairdata_fusion_df = pairdata_fusion_df.sort_values("date", ascending=True, kind="stable")
+
+        cutoff_date = datetime.fromtimestamp(timestamp, timezone.utc).strftime(format='%Y-%m-%d')
+
+        # Store rows after the cutoff
+        ctx.store.write("pair_data_fusion", pairdata_fusion_df, replace={"date": (">", cutoff_date)})
+
+        # Queue GSheets sync
+        sheetkey = config["gsheets"]["pair_data_fusion_sheet_key"]
+        ctx.publisher.sync(sheetkey, "Master", pairdata_fusion_df, ["date", "id", "name"], lambda keys: keys["date"] > cutoff_date)
+
+        logger.info("Pair Data Fusion Ended")
+    except Exception as e:
+        logger.error("Error occurred during Pair Data Fusion process. Error: %s" % e, exc_info=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pull pair day data")
+    parser.add_argument(
+        "--backfill-from",
+        help="Instead of the last two days, stream the history after this date (YYYY-MM-DD) and rebuild revenue from there",
+    )
+    parser.add_argument("--chunk-size", type=int, default=STREAM_CHUNK_SIZE, help="Rows per store write when streaming")
+    parser.add_argument("--no-publish", action="store_true", help="With --backfill-from, only write to the store")
+    args = parser.parse_args()
+
+    ctx = RunContext()
+    if args.backfill_from:
+        start = datetime.strptime(args.backfill_from, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        stream_history(ctx, int(start.timestamp()), args.chunk_size, publish=not args.no_publish)
+    else:
+        run(ctx)
+        ctx.publisher.flush()
+    report()
@@ -1,84 +1,107 @@
 import requests
 import pandas as pd
-import yaml
 from application_logging.logger import logger
-from web3 import Web3
-from web3.middleware import validation
+from application_logging.instrumentation import stage, span, report, count_response
+from retro_utils.amounts import normalize_amounts
+from retro_utils.multicall import Multicall
+from retro_utils.rpc_batch import RPCBatch
+from retro_utils.abis import load_functions
+from retro_utils.context import RunContext
 
 
-# Params
-params_path = "params.yaml"
+@span("fetch")
+def fetch_pool_tokens(ctx, pool_df):
+    """Reads each pool's Merkl distributions in batched calls, one row per pool and token.
 
-def read_params(config_path):
-    with open(config_path) as yaml_file:
-        config = yaml.safe_load(yaml_file)
-    return config
-
-config = read_params(params_path)
-
-try:
-    logger.info("Pool Data Started")
+    The distributions of a pool all carry the same pool balances, the first one's are used.
+    """
+    config = ctx.config
 
     # Params Data
-    price_api = config["api"]["price_api"]
-    fusion_api = config["api"]["fusion_api"]
     provider_url = config["web3"]["provider_url"]
-    merkl_abi = config["web3"]["merkl_abi"]
     merkl_ca = config["web3"]["merkl_ca"]
-
-    # Pull Price
-    try:
-        response = requests.get(price_api)
-        pricelist = []
-        for i in response.json()["data"]:
-            pricelist.append([i["name"], i["address"], i["price"], i["decimals"]])
-
-        price_df = pd.DataFrame(pricelist, columns=["name", "address", "price", "decimals"])
-    except Exception as e:
-        print(e)
-
-    # Request
-    response = requests.get(url=fusion_api)
-    data = response.json()["data"]
-    pool_df = pd.json_normalize(response.json()["data"])[["symbol", "underlyingPool"]]
-    pool_df = pool_df[pool_df["symbol"] != "sAMM-USDC/USDT"]
+    get_distributions = load_functions("merkl")["getActivePoolDistributions"]
 
     # Web3
-    validation.METHODS_TO_VALIDATE = []
-    w3 = Web3(Web3.HTTPProvider(provider_url, request_kwargs={"timeout": 60}))
-    contract_instance = w3.eth.contract(address=merkl_ca, abi=merkl_abi)
-
-    pool_data_list = []
-    for pool_name, pool_address in zip(pool_df["symbol"], pool_df["underlyingPool"]):
-        pool_data = contract_instance.functions.getActivePoolDistributions(pool_address).call()
-        if pool_data != []:
-            token_df = pd.DataFrame(list(zip(pool_data[0][2], pool_data[0][3]))).T
-            token_df.columns = ["address", "decimals", "name", "amount"]
-            token_df["address"] = token_df["address"].str.lower()
-            token_df = token_df.merge(price_df[["address", "price"]], on="address", how="left")
-            token_df["token_amount"] = token_df["price"] * token_df["amount"]
-            token_amount = []
-            for dec, amt in zip(token_df["decimals"], token_df["token_amount"]):
-                decimal = "1"
-                decimal = decimal.ljust(dec + 1, "0")
-                token_amount.append((amt / int(decimal)))
-            token_df["token_amount"] = token_amount
-            
-            pool_data_list.append(
+    rpc_batch = RPCBatch(
+        ctx.provider_pool(provider_url), chunk_size=config["web3"]["rpc_batch_size"], timeout=60
+    )
+    multicall = Multicall(rpc_batch, config["web3"]["multicall_ca"], config["web3"]["multicall_batch_size"])
+    distributions = multicall.aggregate(
+        [(merkl_ca, get_distributions, (pool_address,)) for pool_address in pool_df["underlyingPool"]]
+    )
+
+    rows = []
+    for pool_name, pool_address, pool_distributions in zip(pool_df["symbol"], pool_df["underlyingPool"], distributions):
+        if not pool_distributions:
+            continue
+        _, _, token0, token1, _, _ = pool_distributions[0]
+        for address, decimals, symbol, amount in (token0, token1):
+            rows.append(
                 {
                     "pool_name": pool_name,
                     "pool_address": pool_address,
-                    "pool_data": pool_data,
-                    "total_liquidity": round(token_df["token_amount"].sum(),2)
+                    "address": address.lower(),
+                    "symbol": symbol,
+                    "decimals": decimals,
+                    "amount": amount,
                 }
             )
+    return pd.DataFrame(rows, columns=["pool_name", "pool_address", "address", "symbol", "decimals", "amount"])
 
-    pool_data = pd.DataFrame(pool_data_list)
 
-    pool_data.to_csv("data/pool_data.csv", index=False)
+@span("build")
+def pool_liquidity(tokens_df, prices):
+    """Prices the token balances of ``fetch_pool_tokens`` and totals them per pool."""
+    tokens_df = prices.join(tokens_df, columns=("address", "price"))
+    tokens_df["balance"] = normalize_amounts(tokens_df["amount"], tokens_df["decimals"])
+    tokens_df["token_amount"] = tokens_df["price"] * tokens_df["balance"]
+    # Raw balances are uint256, kept as text so they stay exact
+    tokens_df["amount"] = tokens_df["amount"].astype(str)
 
-    logger.info("Pool Data Ended")
-except Exception as e:
-    logger.error(
-        "Error occurred during Pool Data process. Error: %s" % e, exc_info=True
-    )
+    pool_data = tokens_df.groupby(["pool_name", "pool_address"], sort=False, as_index=False)["token_amount"].sum()
+    pool_data["token_amount"] = pool_data["token_amount"].round(2)
+    pool_data.columns = ["pool_name", "pool_address", "total_liquidity"]
+    return tokens_df, pool_data
+
+
+@stage("pool_data")
+def run(ctx):
+    config = ctx.config
+
+    try:
+        logger.info("Pool Data Started")
+
+        # Params Data
+        fusion_api = config["api"]["fusion_api"]
+
+        # Pull Price
+        try:
+            prices = ctx.prices
+        except Exception as e:
+            print(e)
+
+        # Request
+        response = requests.get(url=fusion_api)
+        count_response("fusion_api", response)
+        pool_df = pd.json_normalize(response.json()["data"])[["symbol", "underlyingPool"]]
+        pool_df = pool_df[pool_df["symbol"] != "sAMM-USDC/USDT"]
+
+        tokens_df = fetch_pool_tokens(ctx, pool_df)
+        tokens_df, pool_data = pool_liquidity(tokens_df, prices)
+
+        # Store the current token balances
+        ctx.store.write("pool_tokens", tokens_df, replace={})
+
+        pool_data.to_csv("data/pool_data.csv", index=False)
+
+        logger.info("Pool Data Ended")
+    except Exception as e:
+        logger.error(
+            "Error occurred during Pool Data process. Error: %s" % e, exc_info=True
+        )
+
+
+if __name__ == "__main__":
+    run(RunContext())
+    report()
@@ -0,0 +1,146 @@
+import os
+import json
+from functools import lru_cache
+
+
+# Contract ABIs live in abis/<name>.json, next to retro_utils
+ABI_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "abis")
+
+
+@lru_cache(maxsize=None)
+def load_abi(name):
+    """Returns the parsed ABI of contract ``name``, read and parsed once per process.
+
+    The same list is handed to every caller, so it must not be modified.
+    """
+    with open(os.path.join(ABI_DIR, name + ".json")) as abi_file:
+        return json.load(abi_file)
+
+
+@lru_cache(maxsize=None)
+def load_functions(name):
+    """Returns contract ``name``'s functions by name, each compiled once per process."""
+    return {fn["name"]: AbiFunction(fn) for fn in load_abi(name) if fn.get("type") == "function"}
+
+
+class AbiFunction:
+    """One ABI function with its selector, encoder and decoder built up front.
+
+    ``encode`` turns arguments into ``eth_call`` calldata for any contract
+    address, and ``decode`` turns a call's result (hex string or bytes) into
+    what a web3 ``.call()`` returns: the single output, or a list of outputs,
+    with addresses checksummed. Neither goes through a web3 contract object, so
+    callers can encode and decode thousands of calls for batching cheaply.
+    """
+
+    def __init__(self, fn_abi):
+        from eth_abi.decoding import TupleDecoder
+        from eth_abi.encoding import TupleEncoder
+        from eth_abi.grammar import parse
+        from eth_abi.registry import registry
+        from eth_utils import keccak
+
+        self.name = fn_abi["name"]
+        self.input_types = [_type_string(param) for param in fn_abi["inputs"]]
+        self.output_types = [_type_string(param) for param in fn_abi.get("outputs", [])]
+        signature = "%s(%s)" % (self.name, ",".join(self.input_types))
+        self.selector = keccak(text=signature)[:4]
+        self._encoder = TupleEncoder(encoders=[registry.get_encoder(t) for t in self.input_types])
+        self._decoder = TupleDecoder(decoders=[registry.get_decoder(t) for t in self.output_types])
+        self._normalizers = [_normalizer(parse(t)) for t in self.output_types]
+
+    def encode(self, *args):
+        """Calldata as a hex string, the form ``eth_call`` takes."""
+        return "0x" + self.encode_bytes(*args).hex()
+
+    def encode_bytes(self, *args):
+        """Calldata as bytes, the form a ``bytes`` argument (e.g. of ``aggregate3``) takes."""
+        return self.selector + self._encoder(args)
+
+    def decode(self, result):
+        from eth_abi.decoding import ContextFramesBytesIO
+
+        values = self._decoder(ContextFramesBytesIO(_to_bytes(result)))
+        values = [normalize(value) for normalize, value in zip(self._normalizers, values)]
+        if len(values) == 1:
+            return values[0]
+        return values
+
+
+@lru_cache(maxsize=None)
+def load_events(name):
+    """Returns contract ``name``'s events by name, each compiled once per process."""
+    return {event["name"]: AbiEvent(event) for event in load_abi(name) if event.get("type") == "event"}
+
+
+class AbiEvent:
+    """One ABI event with its topic and log decoder built up front.
+
+    ``decode`` turns an ``eth_getLogs`` log into a dict of the event's arguments,
+    addresses checksummed. Indexed arguments of dynamic types only have their
+    hash in the topics, those are returned as the raw topic.
+    """
+
+    def __init__(self, event_abi):
+        from eth_abi.decoding import TupleDecoder
+        from eth_abi.grammar import parse
+        from eth_abi.registry import registry
+        from eth_utils import keccak
+
+        self.name = event_abi["name"]
+        types = [_type_string(param) for param in event_abi["inputs"]]
+        self.topic = "0x" + keccak(text="%s(%s)" % (self.name, ",".join(types))).hex()
+        self._indexed = []
+        self._data = []
+        for param, abi_type in zip(event_abi["inputs"], types):
+            if param["indexed"]:
+                parsed = parse(abi_type)
+                decoder = None if parsed.is_dynamic else registry.get_decoder(abi_type)
+                self._indexed.append((param["name"], decoder, _normalizer(parsed)))
+            else:
+                self._data.append((param["name"], abi_type))
+        self._decoder = TupleDecoder(decoders=[registry.get_decoder(abi_type) for _, abi_type in self._data])
+        self._normalizers = [_normalizer(parse(abi_type)) for _, abi_type in self._data]
+
+    def decode(self, log):
+        from eth_abi.decoding import ContextFramesBytesIO
+
+        values = {}
+        for (name, decoder, normalize), topic in zip(self._indexed, log["topics"][1:]):
+            if decoder is None:
+                values[name] = topic
+            else:
+                values[name] = normalize(decoder(ContextFramesBytesIO(_to_bytes(topic))))
+        decoded = self._decoder(ContextFramesBytesIO(_to_bytes(log["data"])))
+        for (name, _), normalize, value in zip(self._data, self._normalizers, decoded):
+            values[name] = normalize(value)
+        return values
+
+
+def _to_bytes(value):
+    if isinstance(value, str):
+        return bytes.fromhex(value[2:] if value.startswith("0x") else value)
+    return bytes(value)
+
+
+def _type_string(param):
+    # Tuples are spelled out as their components, e.g. tuple[] -> (address,bool,bytes)[]
+    if param["type"].startswith("tuple"):
+        components = ",".join(_type_string(component) for component in param["components"])
+        return "(%s)%s" % (components, param["type"][len("tuple"):])
+    return param["type"]
+
+
+def _normalizer(abi_type):
+    # Checksums addresses the way web3 does, anything else is returned as decoded
+    from eth_utils import to_checksum_address
+
+    if "address" not in abi_type.to_type_str():
+        return lambda value: value
+    if abi_type.arrlist:
+        normalize_item = _normalizer(abi_type.item_type)
+        return lambda values: [normalize_item(value) for value in values]
+    if hasattr(abi_type, "components"):
+        normalizers = [_normalizer(component) for component in abi_type.components]
+        return lambda values: tuple(normalize(value) for normalize, value in zip(normalizers, values))
+    return to_checksum_address
@@ -0,0 +1,53 @@
+from decimal import Context, Decimal
+import numpy as np
+import pandas as pd
+
+
+# Largest integer magnitude a float64 holds exactly
+FLOAT_EXACT_LIMIT = 2 ** 53
+
+# Enough digits for any uint256 so scaling never rounds before the final float
+EXACT_CONTEXT = Context(prec=100)
+
+
+def normalize_amounts(raw, decimals):
+    """Converts raw on-chain integer amounts to human units (``raw / 10**decimals``).
+
+    Works on whole columns. Integer columns that fit in a float64 take a numpy
+    fast path. Larger integers (uint256 values held as Python ints in an object
+    column) use exact integer division, and numeric strings such as Dune output
+    are scaled exactly with Decimal; both round to float only once. Returns a Series aligned with ``raw`` when given one.
+    """
+    index = raw.index if isinstance(raw, pd.Series) else None
+    values = np.asarray(raw)
+    decimals = np.broadcast_to(np.asarray(decimals, dtype=np.int64), values.shape)
+
+    if values.dtype.kind == "f" or (
+        values.dtype.kind in "iu" and np.abs(values).max(initial=0) < FLOAT_EXACT_LIMIT
+    ):
+        result = values.astype(np.float64) / np.power(10.0, decimals)
+    elif values.dtype.kind in "iuO" and all(isinstance(value, int) for value in values.tolist()):
+        # Python int / int true division is correctly rounded at any size
+        scales = np.array([10 ** dec for dec in range(decimals.max(initial=0) + 1)], dtype=object)
+        result = (values.astype(object) / scales[decimals]).astype(np.float64)
+    else:
+        result = np.fromiter(
+            (
+                float(_to_decimal(value).scaleb(-int(dec), context=EXACT_CONTEXT))
+                for value, dec in zip(values, decimals)
+            ),
+            dtype=np.float64,
+            count=len(values),
+        )
+
+    if index is not None:
+        return pd.Series(result, index=index)
+    return result
+
+
+def _to_decimal(value):
+    if isinstance(value, np.integer):
+        value = int(value)
+    elif isinstance(value, np.floating):
+        value = float(value)
+    return Decimal(value)
@@ -0,0 +1,132 @@
+import requests
+import pandas as pd
+from application_logging.logger import logger
+from application_logging.instrumentation import span, count_response
+from retro_utils.rpc_batch import RPCError
+
+
+# Store table of resolved (timestamp, block) pairs
+BLOCKS_TABLE = "block_timestamps"
+
+
+class BlockResolver:
+    """Resolves unix timestamps to the last block mined at or before them.
+
+    Resolved pairs are kept in the ``store`` for good, since past mappings never
+    change; only timestamps already behind the chain head are kept. Misses are
+    resolved together: every cached pair narrows the search range of each one,
+    ``block_api`` (``<url><timestamp>`` returning ``{"height": ...}``, such as
+    DefiLlama's) is tried as a hint and checked on chain, and what is left is
+    bisected in lock step, one batched ``eth_getBlockByNumber`` round per step.
+    """
+
+    def __init__(self, rpc_batch, store, block_api=None, session=None):
+        self.rpc_batch = rpc_batch
+        self.store = store
+        self.block_api = block_api
+        self.session = session or requests.Session()
+
+    @span("blocks")
+    def resolve(self, timestamps):
+        """Returns the block of each timestamp, aligned with ``timestamps``."""
+        timestamps = [int(timestamp) for timestamp in timestamps]
+        wanted = sorted(set(timestamps))
+        if not wanted:
+            return []
+
+        cached = self.store.read(BLOCKS_TABLE)
+        blocks = dict(zip(cached.get("timestamp", []), cached.get("block", [])))
+        missing = [timestamp for timestamp in wanted if timestamp not in blocks]
+        if missing:
+            resolved = self._search(missing, cached)
+            blocks.update(resolved)
+            logger.info("Resolved %s timestamps to blocks, %s from cache" % (len(wanted), len(wanted) - len(missing)))
+        return [int(blocks[timestamp]) for timestamp in timestamps]
+
+    def _search(self, timestamps, cached):
+        head, genesis = self._block_timestamps(["latest", 0], as_pairs=True)
+        head_number, head_timestamp = head
+        known = {0: genesis[1], head_number: head_timestamp}
+
+        # Search ranges: ts(low) <= timestamp < ts(high)
+        bounds = {}
+        final = {}
+        for timestamp in timestamps:
+            if timestamp >= head_timestamp:
+                # Later blocks may still land at or before this timestamp
+                final[timestamp] = head_number
+                continue
+            low, high = 0, head_number
+            for cached_timestamp, cached_block in zip(cached.get("timestamp", []), cached.get("block", [])):
+                if cached_timestamp <= timestamp:
+                    low = max(low, int(cached_block))
+                else:
+                    high = min(high, int(cached_block) + 1)
+            bounds[timestamp] = [low, high]
+
+        if self.block_api and bounds:
+            hints = {timestamp: self._hint(timestamp) for timestamp in bounds}
+            hints = {timestamp: hint for timestamp, hint in hints.items() if hint is not None and 0 < hint < head_number}
+            # The API gives the closest block, which may be one past the one wanted
+            numbers = {number for hint in hints.values() for number in (hint - 1, hint, hint + 1)}
+            known.update(self._block_timestamps(sorted(numbers - set(known))))
+            for timestamp, hint in hints.items():
+                for number in (hint - 1, hint, hint + 1):
+                    _narrow(bounds[timestamp], number, known[number], timestamp)
+
+        rounds = 0
+        while True:
+            middles = {
+                timestamp: (low + high) // 2 for timestamp, (low, high) in bounds.items() if high - low > 1
+            }
+            if not middles:
+                break
+            rounds += 1
+            known.update(self._block_timestamps(sorted(set(middles.values()) - set(known))))
+            for timestamp, middle in middles.items():
+                _narrow(bounds[timestamp], middle, known[middle], timestamp)
+        logger.info("Block search took %s batched rounds" % rounds)
+
+        resolved = {timestamp: low for timestamp, (low, high) in bounds.items()}
+        if resolved:
+            self.store.write(
+                BLOCKS_TABLE,
+                pd.DataFrame({"timestamp": list(resolved), "block": list(resolved.values())}),
+            )
+        resolved.update(final)
+        return resolved
+
+    def _hint(self, timestamp):
+        try:
+            response = self.session.get(self.block_api + str(timestamp), timeout=30)
+            count_response("blocks", response)
+            response.raise_for_status()
+            return int(response.json()["height"])
+        except Exception as e:
+            logger.warning("Block API failed for %s, searching on chain. Error: %s" % (timestamp, e))
+            return None
+
+    def _block_timestamps(self, numbers, as_pairs=False):
+        results = self.rpc_batch.send(
+            [
+                ("eth_getBlockByNumber", [number if isinstance(number, str) else hex(number), False])
+                for number in numbers
+            ]
+        )
+        pairs = []
+        for number, result in zip(numbers, results):
+            if isinstance(result, RPCError):
+                raise result
+            if result is None:
+                raise RPCError({"message": "Block %s not found" % number})
+            pairs.append((int(result["number"], 16), int(result["timestamp"], 16)))
+        if as_pairs:
+            return pairs
+        return dict(pairs)
+
+
+def _narrow(bound, number, block_timestamp, timestamp):
+    if block_timestamp <= timestamp:
+        bound[0] = max(bound[0], number)
+    else:
+        bound[1] = min(bound[1], number)
@@ -0,0 +1,178 @@
+import pandas as pd
+from application_logging.logger import logger
+from application_logging.instrumentation import span, count
+from retro_utils.abis import load_events
+from retro_utils.epochs import epoch_of
+from retro_utils.rpc_batch import RPCError
+
+
+# Store table of indexed RewardAdded events, one row per log
+EVENTS_TABLE = "bribe_events"
+
+# Store table of the last block indexed for each bribe contract
+CHECKPOINTS_TABLE = "bribe_events_checkpoints"
+
+# Rewards are summed per bribe contract, token, provider and epoch
+REWARD_KEYS = ["reward_pool", "reward_token", "reward_provider", "epoch"]
+
+
+class BribeIndexer:
+    """Indexes the ``RewardAdded`` events of bribe contracts into the ``store``.
+
+    Each contract has a checkpoint, the last block indexed for it, so a run only
+    scans the blocks mined since the previous one; contracts seen for the first
+    time are scanned from ``start_block``. Blocks are scanned with ``eth_getLogs``
+    in windows of ``block_range`` blocks, a batch of windows per request. A window
+    the node rejects (range or result count too large) halves the range, which is
+    then never grown past it again; batches that come back sparse double it, up
+    to ``max_range``. Only blocks ``confirmations`` behind the head are indexed.
+
+    The event does not name who added the reward. ``notifyRewardAmount`` pulls
+    the reward in with ``transferFrom``, so the provider is the sender of the
+    token ``Transfer`` into the bribe contract just before the event, in the
+    same transaction. Those transfers are scanned alongside the events. Unlike
+    the transaction's sender, this is the funder even when the deposit is relayed
+    by a multisig, router or bot. The epoch of a reward follows ``bribe_data``:
+    epoch ``E`` holds the rewards paid out from the start of ``E + 1``.
+    """
+
+    def __init__(self, rpc_batch, store, start_block, block_range=2000, max_range=100000, confirmations=64):
+        self.rpc_batch = rpc_batch
+        self.store = store
+        self.start_block = start_block
+        self.block_range = block_range
+        self.max_range = max_range
+        self.confirmations = confirmations
+        self.event = load_events("bribe")["RewardAdded"]
+        self.transfer = load_events("erc20")["Transfer"]
+
+    @span("bribe_events")
+    def update(self, contracts):
+        """Indexes ``contracts``' events up to the confirmed head; returns how many were added."""
+        contracts = sorted({contract.lower() for contract in contracts})
+        head = self.rpc_batch.send([("eth_blockNumber", [])])[0]
+        if isinstance(head, RPCError):
+            raise head
+        to_block = int(head, 16) - self.confirmations
+
+        checkpoints = self.store.read(CHECKPOINTS_TABLE)
+        checkpoints = dict(zip(checkpoints.get("contract", []), checkpoints.get("block", [])))
+        groups = {}
+        for contract in contracts:
+            groups.setdefault(int(checkpoints.get(contract, self.start_block - 1)), []).append(contract)
+
+        added = 0
+        for checkpoint, group in sorted(groups.items()):
+            if checkpoint >= to_block:
+                continue
+            logger.info("Indexing bribe events of %s contracts, blocks %s to %s" % (len(group), checkpoint + 1, to_block))
+            for from_block, last_block, logs, transfers in self._scan(group, checkpoint + 1, to_block):
+                events = self._events(logs, transfers)
+                if len(events):
+                    # Rows of a scan cut short are scanned again, replace them
+                    self.store.write(EVENTS_TABLE, events, replace={"reward_pool": group, "block": (">=", from_block)})
+                self.store.write(
+                    CHECKPOINTS_TABLE,
+                    pd.DataFrame({"contract": group, "block": last_block}),
+                    replace={"contract": group},
+                )
+                added += len(events)
+        logger.info("Indexed %s new bribe events" % added)
+        return added
+
+    def rewards(self, epoch):
+        """Rewards added for ``epoch``, summed per contract, token and provider (raw integer amounts)."""
+        events = self.store.read(EVENTS_TABLE, where={"epoch": epoch})
+        if events.empty:
+            return pd.DataFrame(columns=REWARD_KEYS + ["reward_amount"])
+        # Amounts are uint256, kept as text and summed as Python ints
+        events["reward_amount"] = events["reward_amount"].apply(int)
+        return events.groupby(REWARD_KEYS, as_index=False)["reward_amount"].agg(lambda amounts: sum(amounts.tolist()))
+
+    def _scan(self, contracts, from_block, to_block):
+        # Yields (first block, last block, logs, transfers) for each batch of windows scanned
+        # Token transfers of any token into the contracts, matched on the indexed "to"
+        recipients = ["0x" + "0" * 24 + contract[2:] for contract in contracts]
+        start = from_block
+        while start <= to_block:
+            windows = []
+            window_start = start
+            # Each window takes two requests, events and transfers
+            while window_start <= to_block and len(windows) < max(1, self.rpc_batch.chunk_size // 2):
+                window_end = min(window_start + self.block_range - 1, to_block)
+                windows.append((window_start, window_end))
+                window_start = window_end + 1
+
+            calls = []
+            for low, high in windows:
+                blocks = {"fromBlock": hex(low), "toBlock": hex(high)}
+                calls.append(("eth_getLogs", [dict(blocks, address=contracts, topics=[self.event.topic])]))
+                calls.append(("eth_getLogs", [dict(blocks, topics=[self.transfer.topic, None, recipients])]))
+            try:
+                results = self.rpc_batch.send(calls)
+            except Exception as e:
+                results = [RPCError({"message": str(e)})] * len(calls)
+
+            logs = []
+            transfers = []
+            last_block = start - 1
+            for index, (low, high) in enumerate(windows):
+                error = next((item for item in results[2 * index : 2 * index + 2] if isinstance(item, RPCError)), None)
+                if error is not None:
+                    if self.block_range == 1:
+                        raise error
+                    self.block_range = max(1, (high - low + 1) // 2)
+                    self.max_range = self.block_range
+                    logger.warning("eth_getLogs of %s blocks rejected, scanning %s at a time. Error: %s" % (high - low + 1, self.block_range, error))
+                    break
+                logs.extend(results[2 * index])
+                transfers.extend(results[2 * index + 1])
+                last_block = high
+            else:
+                # Sparse windows are cheap to widen
+                if max(len(result) for result in results) < 1000:
+                    self.block_range = min(self.block_range * 2, self.max_range)
+
+            count("bribe_events.blocks", last_block - start + 1)
+            if last_block >= start:
+                yield start, last_block, logs, transfers
+            start = last_block + 1
+
+    def _events(self, logs, transfers):
+        if not logs:
+            return pd.DataFrame()
+        # Transfers by transaction, token and recipient, in log order
+        funders = {}
+        for log in sorted(transfers, key=lambda log: int(log["logIndex"], 16)):
+            # ERC721 Transfers share the topic but index a tokenId and carry no data
+            if len(log["topics"]) != 3:
+                continue
+            values = self.transfer.decode(log)
+            key = (log["transactionHash"], log["address"].lower(), values["to"].lower())
+            funders.setdefault(key, []).append((int(log["logIndex"], 16), values["from"].lower()))
+
+        rows = []
+        for log in logs:
+            values = self.event.decode(log)
+            candidates = funders.get((log["transactionHash"], values["rewardToken"].lower(), log["address"].lower()), [])
+            # The transferFrom of notifyRewardAmount is the last transfer in before the event
+            log_index = int(log["logIndex"], 16)
+            provider = next((sender for index, sender in reversed(candidates) if index < log_index), None)
+            if provider is None:
+                logger.warning("No token transfer into %s found for reward in %s, provider unknown" % (log["address"], log["transactionHash"]))
+                count("bribe_events.unattributed")
+                provider = ""
+            rows.append(
+                {
+                    "epoch": int(epoch_of(values["startTimestamp"])) - 1,
+                    "block": int(log["blockNumber"], 16),
+                    "tx_hash": log["transactionHash"],
+                    "log_index": log_index,
+                    "reward_pool": log["address"].lower(),
+                    "reward_token": values["rewardToken"].lower(),
+                    "reward_provider": provider,
+                    "reward_amount": str(values["reward"]),
+                    "start_timestamp": values["startTimestamp"],
+                }
+            )
+        return pd.DataFrame(rows)
@@ -0,0 +1,175 @@
+import os
+import json
+import threading
+import pandas as pd
+import yaml
+from application_logging.instrumentation import count_response
+from retro_utils.blocks import BlockResolver
+from retro_utils.bribe_events import BribeIndexer
+from retro_utils.dune import DuneClient
+from retro_utils.epochs import GENESIS, next_epoch_timestamp
+from retro_utils.prices import PriceCache
+from retro_utils.publisher import SheetPublisher
+from retro_utils.rpc_batch import RPCBatch
+from retro_utils.store import HistoryStore
+
+
+# Params
+params_path = "params.yaml"
+
+
+# History tables, seeded from the sheet exports of the same name under files
+SEEDED_TABLES = [
+    "daily_data_fusion",
+    "pair_data_fusion",
+    "bribe_data",
+    "fee_data",
+    "vote_data",
+    "emissions_data",
+    "revenue_data",
+]
+
+
+def read_params(config_path):
+    # libyaml's loader when PyYAML was built with it, same result at a fraction of the time
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    with open(config_path) as yaml_file:
+        config = yaml.load(yaml_file, Loader=loader)
+    return config
+
+
+def read_csv(local_path, url):
+    # The checkout already holds the data files, only go to GitHub when it doesn't
+    if os.path.exists(local_path):
+        return pd.read_csv(local_path)
+    return pd.read_csv(url)
+
+
+class RunContext:
+    """State shared by every stage of one run, each piece loaded once on first use.
+
+    Stages may run on different threads, so loading is serialized per key.
+    DataFrames are handed out as copies because stages modify what they read.
+    """
+
+    def __init__(self, config_path=params_path):
+        self.config_path = config_path
+        self._values = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key, loader):
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._values:
+                self._values[key] = loader()
+        return self._values[key]
+
+    @property
+    def config(self):
+        return self._get("config", lambda: read_params(self.config_path))
+
+    @property
+    def ids_df(self):
+        url = self.config["files"]["id_data"]
+        return self._get("ids_df", lambda: read_csv("data/ids_data.csv", url)).copy()
+
+    @property
+    def prices(self):
+        price_api = self.config["api"]["price_api"]
+        price_ttl = self.config["api"]["price_ttl"]
+        return self._get("prices", lambda: PriceCache(price_api, ttl=price_ttl))
+
+    @property
+    def store(self):
+        files = self.config["files"]
+        seeds = {table: files[table] for table in SEEDED_TABLES}
+        return self._get("store", lambda: HistoryStore(files["history_store"], seeds=seeds))
+
+    @property
+    def epoch_timestamp(self):
+        return self._get("epoch_timestamp", next_epoch_timestamp)
+
+    def provider_pool(self, provider_url):
+        def create():
+            from retro_utils.provider_pool import ProviderPool
+
+            fallback_urls = self.config["web3"]["fallback_provider_urls"]
+            urls = [provider_url] + [url for url in fallback_urls if url != provider_url]
+            return ProviderPool(urls, timeout=60)
+
+        return self._get(("provider_pool", provider_url), create)
+
+    def provider_stats(self):
+        """Endpoint stats of every provider pool opened so far."""
+        with self._lock:
+            pools = [value for key, value in list(self._values.items()) if isinstance(key, tuple) and key[0] == "provider_pool"]
+        return [row for pool in pools for row in pool.stats()]
+
+    def block_resolver(self, provider_url):
+        def create():
+            rpc_batch = RPCBatch(self.provider_pool(provider_url), chunk_size=self.config["web3"]["rpc_batch_size"], timeout=60)
+            return BlockResolver(rpc_batch, self.store, block_api=self.config["api"]["block_api"])
+
+        return self._get(("block_resolver", provider_url), create)
+
+    def bribe_indexer(self, provider_url):
+        def create():
+            web3 = self.config["web3"]
+            rpc_batch = RPCBatch(self.provider_pool(provider_url), chunk_size=web3["rpc_batch_size"], timeout=60)
+            # Bribe contracts are scanned from the first epoch on
+            start_block = self.block_resolver(provider_url).resolve([GENESIS])[0]
+            return BribeIndexer(
+                rpc_batch,
+                self.store,
+                start_block,
+                block_range=web3["logs_block_range"],
+                max_range=web3["logs_max_range"],
+                confirmations=web3["logs_confirmations"],
+            )
+
+        return self._get(("bribe_indexer", provider_url), create)
+
+    @property
+    def dune(self):
+        def create():
+            dune = self.config["dune"]
+            return DuneClient(
+                os.environ["DUNE"],
+                base_url=dune["base_url"],
+                max_age=dune["max_age"],
+                deadline=dune["deadline"],
+                page_size=dune["page_size"],
+            )
+
+        return self._get("dune", create)
+
+    @property
+    def gspread_client(self):
+        def authorize():
+            import gspread
+
+            credentials = os.environ["GKEY"]
+            credentials = json.loads(credentials)
+            client = gspread.service_account_from_dict(credentials)
+            # gspread 6 moved the session onto an HTTP client
+            session = client.http_client.session if hasattr(client, "http_client") else client.session
+            session.hooks["response"].append(lambda response, *args, **kwargs: count_response("sheets", response))
+            return client
+
+        return self._get("gspread_client", authorize)
+
+    @property
+    def publisher(self):
+        def create():
+            publish = self.config["publish"]
+            return SheetPublisher(
+                lambda: self.gspread_client,
+                retries=publish["retries"],
+                backoff=publish["backoff"],
+                max_backoff=publish["max_backoff"],
+                chunk_rows=publish["chunk_rows"],
+            )
+
+        return self._get("publisher", create)
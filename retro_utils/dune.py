@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import hashlib
+import requests
+import pandas as pd
+from application_logging.logger import logger
+from application_logging.instrumentation import span, count_response
+
+
+# Execution states after which polling stops
+FINISHED_STATES = {
+    "QUERY_STATE_COMPLETED",
+    "QUERY_STATE_FAILED",
+    "QUERY_STATE_CANCELLED",
+    "QUERY_STATE_EXPIRED",
+}
+
+
+class DuneError(Exception):
+    pass
+
+
+class DuneClient:
+    """Dune API client that only pays for an execution when no fresh enough result exists.
+
+    A result is fresh enough when its execution ended less than ``max_age`` seconds
+    ago and, if given, after ``not_before`` (a unix timestamp, e.g. the epoch start
+    the rows must include). Results are looked up in order in the local cache
+    (``cache_dir``, one JSON lines file per query id and parameters), then as the
+    query's latest result on Dune, and only then executed. Executions are polled
+    with exponential backoff up to ``deadline`` seconds. Rows are read ``page_size``
+    at a time and streamed to the cache as they arrive.
+    """
+
+    def __init__(
+        self,
+        api_key,
+        base_url="https://api.dune.com/api/v1/",
+        cache_dir="cache/dune",
+        max_age=21600,
+        deadline=1800,
+        page_size=10000,
+        timeout=60,
+        session=None,
+    ):
+        self.base_url = base_url
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.deadline = deadline
+        self.page_size = page_size
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.session.headers["x-dune-api-key"] = api_key
+
+    @span("dune")
+    def query(self, query_id, parameters=None, engine="large", max_age=None, not_before=None):
+        """Returns the result rows of ``query_id`` as a DataFrame."""
+        rows = [row for page in self.stream(query_id, parameters, engine, max_age, not_before) for row in page]
+        return pd.DataFrame(rows)
+
+    def stream(self, query_id, parameters=None, engine="large", max_age=None, not_before=None):
+        """Yields the result rows of ``query_id`` page by page, as lists of dicts."""
+        query_id = str(query_id)
+        oldest = time.time() - (self.max_age if max_age is None else max_age)
+        if not_before is not None:
+            oldest = max(oldest, not_before)
+        cache_path = self._cache_path(query_id, parameters)
+
+        ended_at = _cached_ended_at(cache_path)
+        if ended_at is not None and ended_at >= oldest:
+            logger.info("Dune query %s: using cached result" % query_id)
+            yield from _read_cache(cache_path)
+            return
+
+        results_url = None
+        if not parameters:
+            try:
+                latest = self._get("query/%s/results" % query_id, params={"limit": 1})
+            except requests.RequestException as e:
+                logger.warning("Dune query %s: no latest result. Error: %s" % (query_id, e))
+                latest = {}
+            if _ended_at(latest) is not None and _ended_at(latest) >= oldest:
+                logger.info("Dune query %s: reusing latest result" % query_id)
+                results_url = "query/%s/results" % query_id
+        if results_url is None:
+            execution_id = self._execute(query_id, parameters, engine)
+            results_url = "execution/%s/results" % execution_id
+
+        yield from self._stream_to_cache(results_url, cache_path)
+
+    def _execute(self, query_id, parameters, engine):
+        body = {"performance": engine}
+        if parameters:
+            body["query_parameters"] = parameters
+        response = self.session.post(self.base_url + "query/%s/execute" % query_id, json=body, timeout=self.timeout)
+        count_response("dune", response)
+        response.raise_for_status()
+        execution_id = response.json()["execution_id"]
+        logger.info("Dune query %s: started execution %s" % (query_id, execution_id))
+
+        started = time.time()
+        delay = 1
+        while True:
+            state = self._get("execution/%s/status" % execution_id)["state"]
+            if state in FINISHED_STATES:
+                break
+            if time.time() - started + delay > self.deadline:
+                self.session.post(self.base_url + "execution/%s/cancel" % execution_id, timeout=self.timeout)
+                raise DuneError("Dune execution %s did not finish within %ss" % (execution_id, self.deadline))
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+        if state != "QUERY_STATE_COMPLETED":
+            raise DuneError("Dune execution %s ended in %s" % (execution_id, state))
+        logger.info("Dune query %s: execution %s completed in %.0fs" % (query_id, execution_id, time.time() - started))
+        return execution_id
+
+    def _stream_to_cache(self, results_url, cache_path):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        partial_path = cache_path + ".partial"
+        with open(partial_path, "w") as cache_file:
+            offset = 0
+            while offset is not None:
+                page = self._get(results_url, params={"limit": self.page_size, "offset": offset})
+                rows = page["result"]["rows"]
+                if offset == 0:
+                    cache_file.write(json.dumps({"execution_ended_at": page.get("execution_ended_at")}) + "\n")
+                for row in rows:
+                    cache_file.write(json.dumps(row) + "\n")
+                yield rows
+                offset = page.get("next_offset")
+        # Only a fully read result replaces the cache
+        os.replace(partial_path, cache_path)
+
+    def _get(self, path, params=None):
+        response = self.session.get(self.base_url + path, params=params, timeout=self.timeout)
+        count_response("dune", response)
+        response.raise_for_status()
+        return response.json()
+
+    def _cache_path(self, query_id, parameters):
+        key = hashlib.sha1(json.dumps(parameters or {}, sort_keys=True).encode()).hexdigest()[:12]
+        return os.path.join(self.cache_dir, "%s-%s.jsonl" % (query_id, key))
+
+
+def _ended_at(result):
+    ended_at = result.get("execution_ended_at")
+    if not ended_at:
+        return None
+    return pd.Timestamp(ended_at).timestamp()
+
+
+def _cached_ended_at(cache_path):
+    if not os.path.exists(cache_path):
+        return None
+    with open(cache_path) as cache_file:
+        return _ended_at(json.loads(cache_file.readline()))
+
+
+def _read_cache(cache_path, page_size=10000):
+    with open(cache_path) as cache_file:
+        cache_file.readline()
+        page = []
+        for line in cache_file:
+            page.append(json.loads(line))
+            if len(page) == page_size:
+                yield page
+                page = []
+        if page:
+            yield page
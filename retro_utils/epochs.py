@@ -0,0 +1,63 @@
+import time
+import numpy as np
+import pandas as pd
+
+
+# Start of epoch 0, Thursday 27-07-2023 00:00 UTC
+GENESIS = 1690416000
+
+# Epochs are 7 days long and start on Thursday 00:00 UTC
+PERIOD = 7 * 24 * 60 * 60
+
+# How long after an epoch starts the stages still run for that epoch
+FLIP_GRACE = 2 * 60 * 60
+
+
+def epoch_of(timestamp):
+    """Epoch a unix timestamp falls in. Works on scalars and on arrays/Series."""
+    if np.ndim(timestamp):
+        return (np.asarray(timestamp, dtype=np.int64) - GENESIS) // PERIOD
+    return (int(timestamp) - GENESIS) // PERIOD
+
+
+def epoch_start(epoch):
+    """Unix timestamp epoch ``epoch`` starts at. Works on scalars and on arrays/Series."""
+    if np.ndim(epoch):
+        return GENESIS + np.asarray(epoch, dtype=np.int64) * PERIOD
+    return GENESIS + int(epoch) * PERIOD
+
+
+def epochs_of_dates(dates, format=None):
+    """Epoch of each day in a date column (``datetime.date`` objects or strings in ``format``)."""
+    days = pd.to_datetime(pd.Series(dates), format=format, utc=True)
+    timestamps = (days - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)
+    return epoch_of(timestamps.values)
+
+
+def next_epoch_timestamp(now=None):
+    """Start of the epoch the periodic stages are collecting for.
+
+    That is the next epoch's start, except in the first hours after a flip when
+    the epoch that just started is still the one being reported.
+    """
+    if now is None:
+        now = time.time()
+    return epoch_start(epoch_of(now - FLIP_GRACE) + 1)
+
+
+def check_calendar(epoch_df, epoch_daily_df=None):
+    """Cross-checks the arithmetic calendar against ``epoch.csv`` (and ``epoch_daily.csv``).
+
+    Raises ValueError listing the first rows that disagree.
+    """
+    mismatches = epoch_df[epoch_start(epoch_df["epoch"]) != epoch_df["timestamp"]]
+    if epoch_daily_df is not None:
+        daily_epochs = epochs_of_dates(epoch_daily_df["date"], format="%d-%m-%Y")
+        mismatches = pd.concat([mismatches, epoch_daily_df[daily_epochs != epoch_daily_df["epoch"].values]])
+    if len(mismatches):
+        raise ValueError("Epoch calendar does not match the epoch files:\n%s" % mismatches.head())
+
+
+if __name__ == "__main__":
+    check_calendar(pd.read_csv("data/epoch.csv"), pd.read_csv("data/epoch_daily.csv"))
+    print("Epoch calendar matches data/epoch.csv and data/epoch_daily.csv")
@@ -0,0 +1,140 @@
+import pandas as pd
+from application_logging.logger import logger
+from application_logging.instrumentation import span, count
+from retro_utils.abis import load_functions
+from retro_utils.rpc_batch import RPCError
+
+
+# Store table of each reward contract's token list, one row per (contract, index)
+REWARD_TOKENS_TABLE = "reward_tokens"
+
+
+class Multicall:
+    """Aggregates read-only contract calls through a Multicall3 ``aggregate3`` contract.
+
+    Calls are ``(address, function, args)`` triples, ``function`` being an
+    ``AbiFunction`` from ``load_functions``. Every ``aggregate3`` call of a run goes
+    out in one ``RPCBatch``, and results come back aligned with the input, decoded
+    like a web3 ``.call()``. Any call that reverts inside its batch, or every call of
+    a batch whose aggregate call itself fails, is retried on its own, again batched.
+    """
+
+    def __init__(self, rpc_batch, multicall_ca, batch_size=100):
+        self.rpc_batch = rpc_batch
+        self.multicall_ca = multicall_ca
+        self.batch_size = batch_size
+        self.aggregate3 = load_functions("multicall")["aggregate3"]
+
+    @span("multicall")
+    def aggregate(self, calls, block_identifier="latest"):
+        batches = [calls[start : start + self.batch_size] for start in range(0, len(calls), self.batch_size)]
+        responses = self.rpc_batch.eth_call(
+            [
+                (self.multicall_ca, self.aggregate3.encode([(address, True, fn.encode_bytes(*args)) for address, fn, args in batch]))
+                for batch in batches
+            ],
+            block_identifier,
+        )
+
+        return_data = []
+        for batch, response in zip(batches, responses):
+            if isinstance(response, RPCError):
+                logger.warning("Multicall batch of %s calls failed, falling back to single calls. Error: %s" % (len(batch), response))
+                return_data.extend([None] * len(batch))
+            else:
+                return_data.extend(data if success and data else None for success, data in self.aggregate3.decode(response))
+
+        # Single calls for whatever the aggregate calls did not answer
+        retry = [position for position, data in enumerate(return_data) if data is None]
+        if retry:
+            singles = self.rpc_batch.eth_call(
+                [(calls[position][0], calls[position][1].encode(*calls[position][2])) for position in retry],
+                block_identifier,
+            )
+            for position, result in zip(retry, singles):
+                if isinstance(result, RPCError):
+                    address, fn, args = calls[position]
+                    raise RPCError({"message": "%s%s on %s failed: %s" % (fn.name, tuple(args), address, result)})
+                return_data[position] = result
+
+        return [fn.decode(data) for (_, fn, _), data in zip(calls, return_data)]
+
+
+def fetch_reward_data(multicall, contract_addresses, functions, timestamp, store=None):
+    """Reads ``rewardData(token, timestamp)`` for every reward token of every contract.
+
+    ``functions`` is the contracts' ``load_functions`` table. Runs in three batched
+    phases (list lengths, token lists, reward data) and returns one list of
+    ``(token, reward_data)`` pairs per input contract, in input order.
+    With a ``store``, token lists are kept there and only the indices past the
+    cached ones are read; reward lists only grow, so a cached list that is longer
+    than the contract's is read again from the start.
+    """
+    contract_addresses = list(contract_addresses)
+
+    # Phase 1: Reward List Lengths
+    lengths = multicall.aggregate([(address, functions["rewardsListLength"], ()) for address in contract_addresses])
+
+    # Phase 2: Reward Token Lists
+    cached = read_reward_tokens(store, contract_addresses) if store is not None else {}
+    token_lists = []
+    token_calls = []
+    for address, length in zip(contract_addresses, lengths):
+        token_list = cached.get(address.lower(), [])
+        if len(token_list) > length:
+            logger.warning("Reward list of %s shrank from %s to %s tokens, reading it again" % (address, len(token_list), length))
+            token_list = []
+        token_list = list(token_list)
+        for reward_num in range(len(token_list), length):
+            token_calls.append((address, functions["rewardTokens"], (reward_num,)))
+            token_list.append(None)
+        token_lists.append(token_list)
+    count("reward_tokens.cached", sum(length for length in lengths) - len(token_calls))
+    new_tokens = iter(multicall.aggregate(token_calls))
+
+    token_owners = []
+    tokens = []
+    new_rows = []
+    for index, (address, token_list) in enumerate(zip(contract_addresses, token_lists)):
+        for reward_num, token in enumerate(token_list):
+            if token is None:
+                token = next(new_tokens)
+                new_rows.append({"contract": address.lower(), "reward_num": reward_num, "token": token})
+            token_owners.append(index)
+            tokens.append(token)
+    if store is not None and new_rows:
+        new_df = pd.DataFrame(new_rows)
+        # Lists read from the start replace whatever was cached for them
+        restarted = sorted(new_df.loc[new_df["reward_num"] == 0, "contract"])
+        store.write(REWARD_TOKENS_TABLE, new_df, replace={"contract": restarted} if restarted else None)
+
+    # Phase 3: Reward Data
+    reward_calls = [
+        (contract_addresses[index], functions["rewardData"], (token, timestamp))
+        for index, token in zip(token_owners, tokens)
+    ]
+    reward_data = multicall.aggregate(reward_calls)
+
+    rewards = [[] for _ in contract_addresses]
+    for index, token, data in zip(token_owners, tokens, reward_data):
+        rewards[index].append((token, data))
+    return rewards
+
+
+def read_reward_tokens(store, contract_addresses):
+    """Cached token lists of ``contract_addresses``, by lowercased address, in index order."""
+    contracts = sorted({address.lower() for address in contract_addresses})
+    rows = store.read(REWARD_TOKENS_TABLE, where={"contract": contracts})
+    if rows.empty:
+        return {}
+    token_lists = {}
+    for contract, group in rows.groupby("contract"):
+        group = group.sort_values("reward_num")
+        # Only the unbroken run of indices from 0 is usable
+        token_list = []
+        for reward_num, token in zip(group["reward_num"], group["token"]):
+            if reward_num != len(token_list):
+                break
+            token_list.append(token)
+        token_lists[contract] = token_list
+    return token_lists
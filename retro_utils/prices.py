@@ -0,0 +1,67 @@
+import os
+import json
+import time
+import requests
+import pandas as pd
+from application_logging.logger import logger
+from application_logging.instrumentation import span, count_response
+
+
+class PriceCache:
+    """Snapshot of the ``price_api`` asset list, fetched at most once per ``ttl`` seconds.
+
+    The snapshot is persisted to ``cache_path`` so stages running in separate
+    processes within the TTL share one fetch and value tokens with the same prices.
+    Tokens can be looked up by address (any case) or by name.
+    """
+
+    def __init__(self, price_api, cache_path="cache/prices.json", ttl=600):
+        self.price_api = price_api
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.data = self._load()
+
+        self.frame = pd.DataFrame(
+            [[i["name"], i["address"].lower(), i["price"], i["decimals"]] for i in self.data["data"]],
+            columns=["name", "address", "price", "decimals"],
+        )
+        self.index = {}
+        for name, address, price, decimals in self.frame.itertuples(index=False):
+            self.index.setdefault(address, (price, decimals))
+            self.index.setdefault(name, (price, decimals))
+
+    @span("prices")
+    def _load(self):
+        if os.path.exists(self.cache_path):
+            with open(self.cache_path) as cache_file:
+                snapshot = json.load(cache_file)
+            if time.time() - snapshot["fetched_at"] < self.ttl:
+                return snapshot["data"]
+
+        response = requests.get(self.price_api, timeout=60)
+        count_response("prices", response)
+        response.raise_for_status()
+        data = response.json()
+
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = self.cache_path + ".tmp"
+            with open(tmp_path, "w") as cache_file:
+                json.dump({"fetched_at": time.time(), "data": data}, cache_file)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.warning("Could not persist price snapshot. Error: %s" % e)
+        return data
+
+    def lookup(self, key):
+        """Returns ``(price, decimals)`` for a token address or name."""
+        if key.startswith("0x"):
+            key = key.lower()
+        return self.index[key]
+
+    def price(self, key):
+        return self.lookup(key)[0]
+
+    def join(self, df, left_on="address", columns=("name", "address", "price", "decimals"), how="left"):
+        """Merges price columns onto ``df`` by token address in one vectorized join."""
+        return df.merge(self.frame[list(columns)], left_on=left_on, right_on="address", how=how)
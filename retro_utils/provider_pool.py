@@ -0,0 +1,118 @@
+import time
+import threading
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from application_logging.logger import logger
+from application_logging.instrumentation import count, count_response
+
+
+# Statuses that mean the node is struggling rather than the request being wrong
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Weight of the newest sample in an endpoint's moving average latency
+LATENCY_WEIGHT = 0.3
+
+
+class Endpoint:
+    def __init__(self, url, pool_maxsize):
+        self.url = url
+        # Endpoint URLs often carry an API key, only the host is ever logged
+        self.name = urlparse(url).netloc
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.requests = 0
+        self.errors = 0
+        self.latency = None
+        self.down_until = 0
+
+
+class ProviderPool:
+    """Routes JSON-RPC payloads over several RPC endpoints of the same chain.
+
+    Each endpoint keeps its own keep-alive session. Requests go to the healthy
+    endpoint with the lowest moving average latency; an endpoint that fails
+    (connection error, timeout, overload status) is skipped for ``cooldown``
+    seconds and the payload is sent again to the next endpoint, up to
+    ``retries`` times. ``RPCBatch`` sends its batches, all reads, through ``post``.
+    """
+
+    def __init__(self, endpoint_urls, timeout=60, retries=2, cooldown=30, pool_maxsize=16):
+        self.endpoints = [Endpoint(url, pool_maxsize) for url in endpoint_urls]
+        self.timeout = timeout
+        self.retries = retries
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+
+    def post(self, body, retry=True):
+        """POSTs a JSON-RPC body (bytes) and returns the ``requests.Response``.
+
+        With ``retry`` a failed attempt moves on to the next endpoint. Once out of
+        endpoints or retries, the last error is raised, or the last overload
+        response returned.
+        """
+        tried = []
+        while True:
+            endpoint = self._pick(tried)
+            tried.append(endpoint)
+            started = time.perf_counter()
+            try:
+                response = endpoint.session.post(
+                    endpoint.url,
+                    data=body,
+                    headers={"Content-Type": "application/json"},
+                    timeout=self.timeout,
+                )
+                error = None
+                if response.status_code in RETRY_STATUSES:
+                    error = requests.HTTPError("HTTP %s" % response.status_code, response=response)
+            except requests.RequestException as e:
+                response = None
+                error = e
+            self._record(endpoint, time.perf_counter() - started, error)
+            if response is not None:
+                count_response("rpc", response)
+            if error is not None:
+                count("rpc.errors")
+
+            if error is None:
+                return response
+            if not retry or len(tried) > self.retries or len(tried) == len(self.endpoints):
+                if response is not None:
+                    return response
+                raise error
+            logger.warning("RPC request to %s failed, trying another endpoint. Error: %s" % (endpoint.name, error))
+
+    def stats(self):
+        """Per endpoint request and error counts and moving average latency (ms)."""
+        with self._lock:
+            return [
+                {
+                    "endpoint": endpoint.name,
+                    "requests": endpoint.requests,
+                    "errors": endpoint.errors,
+                    "latency_ms": None if endpoint.latency is None else round(endpoint.latency * 1000, 1),
+                }
+                for endpoint in self.endpoints
+            ]
+
+    def _pick(self, tried):
+        now = time.monotonic()
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in tried]
+            healthy = [endpoint for endpoint in candidates if endpoint.down_until <= now]
+            # Endpoints without a sample yet sort first, so each gets measured
+            return min(healthy or candidates, key=lambda endpoint: endpoint.latency or 0)
+
+    def _record(self, endpoint, elapsed, error):
+        with self._lock:
+            endpoint.requests += 1
+            if error is not None:
+                endpoint.errors += 1
+                endpoint.down_until = time.monotonic() + self.cooldown
+            elif endpoint.latency is None:
+                endpoint.latency = elapsed
+            else:
+                endpoint.latency += LATENCY_WEIGHT * (elapsed - endpoint.latency)
@@ -0,0 +1,255 @@
+import json
+import time
+import random
+import threading
+import requests
+from application_logging.logger import logger
+from application_logging.instrumentation import span, count
+from retro_utils.sheet_sync import key_ranges, plan_sync
+
+
+# Largest batchUpdate body sent at once, Sheets rejects much larger ones
+MAX_REQUEST_BYTES = 2 * 1024 * 1024
+
+# Responses worth retrying: quota exceeded and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class SheetPublisher:
+    """Queues the sheet writes of every stage and sends them together, behind the run.
+
+    Stages ``sync`` (see ``plan_sync``) or ``append`` rows and go on; ``flush``
+    then opens each spreadsheet once and coalesces its queued writes: the key
+    columns of all its syncs are read in one batchGet, their requests go out in
+    as few batchUpdates as ``MAX_REQUEST_BYTES`` allows, and appends to the same
+    sheet are joined into one append per ``chunk_rows`` rows; syncs paste rows
+    ``chunk_rows`` at a time too. Requests refused for quota (429) or by a server
+    error are retried with exponential backoff and full jitter, at most
+    ``retries`` times. Reads are also retried on connection errors and timeouts;
+    writes are not, as a write whose response was lost may have been applied.
+    A sync cut off that way reads its keys again and is planned anew from the
+    sheet as it now is; an append is not sent again, so it cannot land twice,
+    and is reported as failed. A write that still fails is reported,
+    never raised, so sheet I/O does not decide whether a run succeeds; the store
+    already holds the rows, and the next sync of the same scope catches up.
+    """
+
+    def __init__(self, client_factory, retries=6, backoff=2, max_backoff=64, chunk_rows=5000, sleep=time.sleep):
+        self.client_factory = client_factory
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.chunk_rows = chunk_rows
+        self.sleep = sleep
+        self._queue = []
+        self._lock = threading.Lock()
+
+    def sync(self, sheet_key, sheet_name, df, key_columns, scope):
+        """Queues making the rows of ``sheet_name`` selected by ``scope`` match ``df`` (see ``plan_sync``)."""
+        self._put({"kind": "sync", "sheet_key": sheet_key, "sheet_name": sheet_name, "df": df, "key_columns": key_columns, "scope": scope})
+
+    def append(self, sheet_key, sheet_name, values, value_input_option="USER_ENTERED"):
+        """Queues appending the rows ``values`` to ``sheet_name`` of spreadsheet ``sheet_key``."""
+        self._put({"kind": "append", "sheet_key": sheet_key, "sheet_name": sheet_name, "values": values, "option": value_input_option})
+
+    def _put(self, job):
+        job.update({"rows": len(job.get("df", job.get("values"))), "requests": 0, "retries": 0, "error": None})
+        with self._lock:
+            self._queue.append(job)
+
+    @span("publish")
+    def flush(self):
+        """Sends everything queued, spreadsheet by spreadsheet; returns one report row per queued write."""
+        with self._lock:
+            jobs = self._queue
+            self._queue = []
+        if not jobs:
+            return []
+
+        by_sheet = {}
+        for job in jobs:
+            by_sheet.setdefault(job["sheet_key"], []).append(job)
+        try:
+            client = self.client_factory()
+        except Exception as e:
+            self._fail(jobs, e)
+            client = None
+        if client is not None:
+            for sheet_key, sheet_jobs in by_sheet.items():
+                try:
+                    gs = self._call(sheet_jobs, client.open_by_key, sheet_key)
+                except Exception as e:
+                    self._fail(sheet_jobs, e)
+                    continue
+                for round_jobs in _rounds(sheet_jobs):
+                    self._publish_round(gs, round_jobs)
+
+        report = [
+            {
+                "sheet_key": job["sheet_key"],
+                "sheet_name": job["sheet_name"],
+                "kind": job["kind"],
+                "rows": job["rows"],
+                "requests": job["requests"],
+                "retries": job["retries"],
+                "status": "failed" if job["error"] else "sent",
+                "error": job["error"],
+            }
+            for job in jobs
+        ]
+        failed = [row for row in report if row["error"]]
+        count("sheets.failed", len(failed))
+        logger.info(
+            "Published %s sheet writes (%s rows, %s requests, %s retries), %s failed"
+            % (
+                len(report),
+                sum(row["rows"] for row in report),
+                sum(row["requests"] for row in report),
+                sum(row["retries"] for row in report),
+                len(failed),
+            )
+        )
+        for row in failed:
+            logger.warning("Sheet write to %s/%s failed, its rows are only in the store. Error: %s" % (row["sheet_key"], row["sheet_name"], row["error"]))
+        return report
+
+    def _publish_round(self, gs, jobs):
+        syncs = [job for job in jobs if job["kind"] == "sync"]
+        if syncs:
+            try:
+                self._sync(gs, syncs)
+            except Exception as e:
+                self._fail([job for job in syncs if job["error"] is None], e)
+
+        appends = {}
+        for job in jobs:
+            if job["kind"] == "append":
+                appends.setdefault((job["sheet_name"], job["option"]), []).append(job)
+        for (sheet_name, option), append_jobs in appends.items():
+            values = [row for job in append_jobs for row in job["values"]]
+            sent = 0
+            try:
+                for start in range(0, len(values), self.chunk_rows):
+                    chunk = values[start : start + self.chunk_rows]
+                    self._call(append_jobs, gs.values_append, sheet_name, {"valueInputOption": option}, {"values": chunk}, write=True)
+                    sent += len(chunk)
+            except Exception as e:
+                self._fail(append_jobs, "%s (%s of %s rows confirmed appended)" % (e, sent, len(values)))
+            count("sheets.rows_written", sent)
+
+    def _sync(self, gs, jobs):
+        for attempt in range(self.retries + 1):
+            planned, update_requests = self._plan(gs, jobs)
+            try:
+                # Each job works on its own sheet, so their requests may share a batchUpdate
+                for batch in _batches(update_requests, MAX_REQUEST_BYTES):
+                    self._call(planned, gs.batch_update, {"requests": batch}, write=True)
+                break
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # The lost batch may have been applied, and the row numbers planned
+                # after it no longer hold: read the keys again and plan anew
+                if attempt == self.retries:
+                    raise
+                self._wait(planned, attempt, e)
+        for job in planned:
+            count("sheets.rows_written", job["summary"]["updated"] + job["summary"]["inserted"])
+            logger.info("Synced %s rows of %s/%s: %s" % (job["rows"], job["sheet_key"], job["sheet_name"], job["summary"]))
+
+    def _plan(self, gs, jobs):
+        # Reads the sheets' keys and plans every job; returns the planned jobs and their requests
+        metadata = self._call(jobs, gs.fetch_sheet_metadata)
+        sheets = {sheet["properties"]["title"]: sheet["properties"] for sheet in metadata["sheets"]}
+
+        ranges = [key_ranges(job["sheet_name"], job["df"], job["key_columns"]) for job in jobs]
+        value_ranges = self._call(jobs, gs.values_batch_get, [r for job_ranges in ranges for r in job_ranges])["valueRanges"]
+
+        update_requests = []
+        planned = []
+        position = 0
+        for job, job_ranges in zip(jobs, ranges):
+            job_value_ranges = value_ranges[position : position + len(job_ranges)]
+            position += len(job_ranges)
+            properties = sheets.get(job["sheet_name"])
+            if properties is None:
+                job["error"] = "No sheet named %s" % job["sheet_name"]
+                continue
+            try:
+                job_requests, summary = plan_sync(
+                    properties["sheetId"],
+                    properties["gridProperties"]["rowCount"],
+                    job["df"],
+                    job["key_columns"],
+                    job["scope"],
+                    job_value_ranges,
+                    self.chunk_rows,
+                )
+            except Exception as e:
+                self._fail([job], e)
+                continue
+            job["summary"] = summary
+            update_requests.extend(job_requests)
+            planned.append(job)
+        return planned, update_requests
+
+    def _call(self, jobs, fn, *args, write=False):
+        # Retries quota and server errors, charging the request and retries to every job it serves;
+        # reads are also retried on connection errors, writes may have been applied
+        for job in jobs:
+            job["requests"] += 1
+        for attempt in range(self.retries + 1):
+            try:
+                return fn(*args)
+            except Exception as e:
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                transient = status in RETRY_STATUSES or (
+                    not write and isinstance(e, (requests.ConnectionError, requests.Timeout))
+                )
+                if not transient or attempt == self.retries:
+                    raise
+                self._wait(jobs, attempt, status or e)
+
+    def _wait(self, jobs, attempt, reason):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        logger.warning("Sheets request failed (%s), retrying in %.1fs" % (reason, delay))
+        count("sheets.retries")
+        for job in jobs:
+            job["retries"] += 1
+        self.sleep(delay)
+
+    def _fail(self, jobs, error):
+        for job in jobs:
+            job["error"] = str(error) or repr(error)
+
+
+def _rounds(jobs):
+    # Splits a spreadsheet's jobs, in queue order, into rounds that can be sent together:
+    # a synced sheet is read and rewritten by row number, so nothing else may touch it in its round
+    rounds = []
+    synced = set()
+    appended = set()
+    for job in jobs:
+        sheet_name = job["sheet_name"]
+        conflict = sheet_name in synced or (job["kind"] == "sync" and sheet_name in appended)
+        if not rounds or conflict:
+            rounds.append([])
+            synced = set()
+            appended = set()
+        rounds[-1].append(job)
+        (synced if job["kind"] == "sync" else appended).add(sheet_name)
+    return rounds
+
+
+def _batches(requests, max_bytes):
+    # Groups requests, in order, into batches whose JSON stays under max_bytes
+    batch = []
+    size = 0
+    for request in requests:
+        request_size = len(json.dumps(request))
+        if batch and size + request_size > max_bytes:
+            yield batch
+            batch = []
+            size = 0
+        batch.append(request)
+        size += request_size
+    if batch:
+        yield batch
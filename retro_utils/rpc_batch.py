@@ -0,0 +1,129 @@
+import json
+import time
+import random
+import requests
+from application_logging.logger import logger
+from application_logging.instrumentation import span, count, count_response
+
+
+# Statuses that mean the node is rate limiting or struggling, worth waiting out
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class RPCError(Exception):
+    """Error object returned by the node for a single request of a batch."""
+
+    def __init__(self, error):
+        self.code = error.get("code")
+        self.data = error.get("data")
+        super().__init__(error.get("message", error))
+
+
+class RPCBatch:
+    """Sends JSON-RPC requests as array-of-requests POSTs.
+
+    ``send`` takes ``(method, params)`` pairs and returns one entry per pair, in
+    input order: the ``result`` value, or an ``RPCError`` for items the node
+    rejected. Requests are chunked to ``chunk_size``. A chunk refused for rate
+    limiting or a server error (429, 5xx) or lost to a connection error is sent
+    again after an exponential backoff with full jitter, at most ``retries`` times;
+    a chunk refused as a whole for any other reason (too large, over the batch
+    limit) is split in half and retried. Calls that still fail come back as
+    ``RPCError`` entries, leaving the results of every other chunk intact.
+    ``provider`` is an endpoint URL or a ``ProviderPool`` to route batches through.
+    """
+
+    def __init__(self, provider, chunk_size=50, timeout=60, session=None, retries=4, backoff=1, max_backoff=30, sleep=time.sleep):
+        self.provider = provider
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+
+    @span("rpc_batch")
+    def send(self, calls):
+        count("rpc.calls", len(calls))
+        results = []
+        for start in range(0, len(calls), self.chunk_size):
+            results.extend(self._send_chunk(calls[start : start + self.chunk_size]))
+        return results
+
+    def _post(self, payload):
+        if isinstance(self.provider, str):
+            response = self.session.post(self.provider, json=payload, timeout=self.timeout)
+            count_response("rpc", response)
+            return response
+        return self.provider.post(json.dumps(payload).encode())
+
+    def eth_call(self, calls, block_identifier="latest", retries=0):
+        """Batched ``eth_call`` for ``(to, data)`` pairs; results are hex strings.
+
+        Items the node rejected are sent again, batched, up to ``retries`` times.
+        """
+        results = self.send(
+            [("eth_call", [{"to": to, "data": data}, block_identifier]) for to, data in calls]
+        )
+        for _ in range(retries):
+            failed = [position for position, result in enumerate(results) if isinstance(result, RPCError)]
+            if not failed:
+                break
+            logger.warning("Retrying %s rejected eth_calls. Error: %s" % (len(failed), results[failed[0]]))
+            retried = self.send(
+                [("eth_call", [{"to": calls[position][0], "data": calls[position][1]}, block_identifier]) for position in failed]
+            )
+            for position, result in zip(failed, retried):
+                results[position] = result
+        return results
+
+    def _send_chunk(self, chunk):
+        payload = [
+            {"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}
+            for request_id, (method, params) in enumerate(chunk)
+        ]
+        for attempt in range(self.retries + 1):
+            try:
+                response = self._post(payload)
+                error = None
+                if response.status_code in RETRY_STATUSES:
+                    error = "HTTP %s" % response.status_code
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response = None
+                error = e
+            if error is None or attempt == self.retries:
+                break
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            logger.warning("RPC batch of %s failed (%s), retrying in %.1fs" % (len(chunk), error, delay))
+            count("rpc.retries")
+            self.sleep(delay)
+        if error is not None:
+            return [RPCError({"message": "RPC batch failed: %s" % error})] * len(chunk)
+        try:
+            body = response.json() if response.content else None
+        except ValueError:
+            # Gateways answer oversized payloads with an HTML error page
+            body = None
+
+        if response.status_code != 200 or not isinstance(body, list):
+            if len(chunk) > 1:
+                logger.warning("RPC batch of %s rejected, splitting. Response: %s" % (len(chunk), body))
+                middle = len(chunk) // 2
+                return self._send_chunk(chunk[:middle]) + self._send_chunk(chunk[middle:])
+            if isinstance(body, dict) and isinstance(body.get("error"), dict):
+                return [RPCError(body["error"])]
+            return [RPCError({"code": response.status_code, "message": "HTTP %s: %s" % (response.status_code, body)})]
+
+        # Batch responses may come back in any order, match them on id
+        by_id = {item.get("id"): item for item in body}
+        results = []
+        for request_id in range(len(chunk)):
+            item = by_id.get(request_id)
+            if item is None:
+                results.append(RPCError({"message": "Missing response for request %s" % request_id}))
+            elif "error" in item:
+                results.append(RPCError(item["error"]))
+            else:
+                results.append(item["result"])
+        return results
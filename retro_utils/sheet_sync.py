@@ -0,0 +1,139 @@
+import math
+import pandas as pd
+
+
+# Default rows per pasteData request, so large writes go out in several
+PASTE_ROWS = 5000
+
+
+def key_ranges(sheet_name, df, key_columns):
+    """A1 ranges of the key columns ``plan_sync`` needs read back, from the first data row down."""
+    key_positions = [df.columns.get_loc(column) for column in key_columns]
+    return ["%s!%s2:%s" % (sheet_name, column_letter(p), column_letter(p)) for p in key_positions]
+
+
+def plan_sync(sheet_id, row_count, df, key_columns, scope, value_ranges, paste_rows=PASTE_ROWS):
+    """The batchUpdate requests that make the rows of a sheet selected by ``scope`` match ``df``.
+
+    ``df`` columns must be in sheet column order; ``key_columns`` name the columns that
+    identify a row. ``value_ranges`` are those columns as read back from ``key_ranges``
+    (one batchGet), as displayed strings. ``scope`` takes that key DataFrame and
+    returns a boolean mask of the existing rows ``df`` is authoritative for, e.g.
+    every row of the current epoch. Scoped rows whose key is in ``df`` are
+    overwritten in place, the rest of the scoped rows are deleted, and new keys are
+    appended, touching only what differs; rows do not need to be contiguous.
+    Writes are pasted ``paste_rows`` rows at a time. ``sheet_id`` and ``row_count``
+    are the sheet's properties. Requests refer to row numbers as read, so they must
+    be sent in order and planned again if the sheet may have changed. Returns them
+    with the counts of updated, inserted and deleted rows.
+    """
+    columns = [[row[0] if row else "" for row in value_range.get("values", [])] for value_range in value_ranges]
+    data_rows = max([len(column) for column in columns] + [0])
+    existing = pd.DataFrame(
+        {key: column + [""] * (data_rows - len(column)) for key, column in zip(key_columns, columns)},
+        columns=key_columns,
+        dtype=object,
+    )
+    existing["row"] = existing.index + 2
+    existing = existing[scope(existing[key_columns]).values]
+
+    existing_rows = dict(zip(_row_keys(existing[key_columns]), existing["row"]))
+    new_keys = _row_keys(df[key_columns])
+
+    updates = []
+    inserts = []
+    for key, values in zip(new_keys, df.values.tolist()):
+        if key in existing_rows:
+            updates.append((existing_rows.pop(key), values))
+        else:
+            inserts.append(values)
+    deletes = sorted(existing_rows.values())
+
+    requests = []
+    for start_row, rows in _runs(sorted(updates, key=lambda update: update[0])):
+        requests.extend(_pastes(sheet_id, start_row - 1, rows, paste_rows))
+    for start_row, rows in reversed(_runs([(row, None) for row in deletes])):
+        requests.append(
+            {
+                "deleteDimension": {
+                    "range": {
+                        "sheetId": sheet_id,
+                        "dimension": "ROWS",
+                        "startIndex": start_row - 1,
+                        "endIndex": start_row - 1 + len(rows),
+                    }
+                }
+            }
+        )
+    if inserts:
+        last_row = 1 + data_rows - len(deletes)
+        missing_rows = last_row + len(inserts) - (row_count - len(deletes))
+        if missing_rows > 0:
+            requests.append({"appendDimension": {"sheetId": sheet_id, "dimension": "ROWS", "length": missing_rows}})
+        requests.extend(_pastes(sheet_id, last_row, inserts, paste_rows))
+
+    summary = {"updated": len(updates), "inserted": len(inserts), "deleted": len(deletes)}
+    return requests, summary
+
+
+def column_letter(position):
+    """Zero-based column position to its A1 letter(s)."""
+    letters = ""
+    position += 1
+    while position:
+        position, remainder = divmod(position - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def _row_keys(key_df):
+    # Keys compare as displayed strings; repeated keys are told apart by occurrence
+    keys = [tuple(_key_value(value) for value in row) for row in key_df.values.tolist()]
+    seen = {}
+    row_keys = []
+    for key in keys:
+        seen[key] = seen.get(key, -1) + 1
+        row_keys.append(key + (seen[key],))
+    return row_keys
+
+
+def _key_value(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def _runs(rows):
+    # Groups (row number, values) pairs into runs of consecutive row numbers
+    runs = []
+    for row, values in rows:
+        if runs and runs[-1][0] + len(runs[-1][1]) == row:
+            runs[-1][1].append(values)
+        else:
+            runs.append((row, [values]))
+    return runs
+
+
+def _pastes(sheet_id, row_index, rows, paste_rows):
+    return [
+        _paste(sheet_id, row_index + start, rows[start : start + paste_rows])
+        for start in range(0, len(rows), paste_rows)
+    ]
+
+
+def _paste(sheet_id, row_index, rows):
+    # pasteData parses cells like typed input, same as USER_ENTERED appends
+    return {
+        "pasteData": {
+            "coordinate": {"sheetId": sheet_id, "rowIndex": row_index, "columnIndex": 0},
+            "data": "\n".join("\t".join(_cell(value) for value in row) for row in rows),
+            "type": "PASTE_NORMAL",
+            "delimiter": "\t",
+        }
+    }
+
+
+def _cell(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    return str(value)
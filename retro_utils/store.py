@@ -0,0 +1,220 @@
+import math
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+import pandas as pd
+from application_logging.logger import logger
+from application_logging.instrumentation import span, count
+
+
+# Columns that get an index when a table is created, for filtering on them
+INDEXED_COLUMNS = ("epoch", "date")
+
+
+class HistoryStore:
+    """Local SQLite store that holds each dataset's full history, one table per dataset.
+
+    Stages write their rows here and read history back from here, with filters
+    pushed down into SQL. Google Sheets is only a publish target. A table that
+    does not exist yet is first seeded from its ``seeds`` source (the sheet's CSV
+    export), so the store starts with the history the sheets already hold.
+    Like the sheets, rows are positional: a frame written to an existing table
+    takes that table's column names.
+    """
+
+    def __init__(self, path="data/history.db", seeds=None):
+        self.path = path
+        self.seeds = seeds or {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _connect(self):
+        with self._lock:
+            connection = sqlite3.connect(self.path, timeout=60)
+            try:
+                with connection:
+                    yield connection
+            finally:
+                connection.close()
+
+    def _tables(self, connection):
+        rows = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        return {row[0] for row in rows}
+
+    def _ensure(self, connection, table):
+        if table in self._tables(connection) or table not in self.seeds:
+            return
+        logger.info("Seeding history table %s from %s" % (table, self.seeds[table]))
+        self._create(connection, table, pd.read_csv(self.seeds[table]))
+
+    def _create(self, connection, table, df):
+        df.to_sql(table, connection, index=False)
+        for column in INDEXED_COLUMNS:
+            if column in df.columns:
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS "%s_%s" ON "%s" ("%s")' % (table, column, table, column)
+                )
+
+    def columns(self, table):
+        with self._connect() as connection:
+            self._ensure(connection, table)
+            return [row[1] for row in connection.execute('PRAGMA table_info("%s")' % table)]
+
+    @span("store_read")
+    def read(self, table, where=None, columns=None):
+        """Returns the rows of ``table`` that match ``where``.
+
+        ``where`` maps a column to a value (equality), a list (IN) or an
+        ``(operator, value)`` pair such as ``(">", "2024-01-01")``.
+        """
+        clause, params = _where(where)
+        selected = ", ".join('"%s"' % column for column in columns) if columns else "*"
+        with self._connect() as connection:
+            self._ensure(connection, table)
+            if table not in self._tables(connection):
+                return pd.DataFrame(columns=columns)
+            df = pd.read_sql('SELECT %s FROM "%s"%s' % (selected, table, clause), connection, params=params)
+        count("store.rows_read", len(df))
+        return df
+
+    @span("store_write")
+    def write(self, table, df, replace=None):
+        """Replaces the rows matching ``replace`` (same form as ``where``) with ``df``.
+
+        ``replace=None`` appends; ``replace={}`` replaces the whole table.
+        """
+        count("store.rows_written", len(df))
+        with self._connect() as connection:
+            self._ensure(connection, table)
+            if table not in self._tables(connection):
+                self._create(connection, table, df)
+                return
+            existing_columns = [row[1] for row in connection.execute('PRAGMA table_info("%s")' % table)]
+            if len(existing_columns) == len(df.columns):
+                df = df.set_axis(existing_columns, axis=1)
+            if replace is not None:
+                clause, params = _where(replace)
+                connection.execute('DELETE FROM "%s"%s' % (table, clause), params)
+            df.to_sql(table, connection, index=False, if_exists="append")
+
+    def drop(self, table):
+        with self._connect() as connection:
+            connection.execute('DROP TABLE IF EXISTS "%s"' % table)
+
+    @span("store_write")
+    def swap_in(self, staging, table, replace=None):
+        """Moves every row of table ``staging`` into ``table`` and drops ``staging``.
+
+        Rows are matched by position, as in ``write``. In one transaction, so
+        ``table`` holds either its old rows or the staged ones in place of the
+        rows matching ``replace`` (same form as in ``write``).
+        """
+        with self._connect() as connection:
+            self._ensure(connection, table)
+            if table not in self._tables(connection):
+                connection.execute('ALTER TABLE "%s" RENAME TO "%s"' % (staging, table))
+                return
+            if replace is not None:
+                clause, params = _where(replace)
+                connection.execute('DELETE FROM "%s"%s' % (table, clause), params)
+            connection.execute('INSERT INTO "%s" SELECT * FROM "%s"' % (table, staging))
+            connection.execute('DROP TABLE "%s"' % staging)
+
+    def dump(self, directory):
+        """Writes each table to ``directory`` as ``<table>.sql``, one INSERT per row in rowid order.
+
+        Unlike the database file, the dumps diff and merge line by line, so
+        runs that wrote different tables can both commit theirs. Dumps of
+        tables the store no longer holds are removed.
+        """
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            tables = self._tables(connection)
+            for table in sorted(tables):
+                # The table's CREATE TABLE, then its indexes
+                schema = connection.execute(
+                    "SELECT sql FROM sqlite_master WHERE tbl_name = ? AND sql IS NOT NULL ORDER BY type DESC, name", (table,)
+                ).fetchall()
+                with open(os.path.join(directory, table + ".sql"), "w", encoding="utf-8", newline="\n") as f:
+                    for (sql,) in schema:
+                        f.write(sql + ";\n")
+                    for row in connection.execute('SELECT * FROM "%s" ORDER BY rowid' % table):
+                        f.write('INSERT INTO "%s" VALUES(%s);\n' % (table, ",".join(_literal(value) for value in row)))
+        for name in os.listdir(directory):
+            if name.endswith(".sql") and name[: -len(".sql")] not in tables:
+                os.remove(os.path.join(directory, name))
+
+    def load(self, directory):
+        """Replaces the store with the tables dumped to ``directory`` by ``dump``.
+
+        Without any dump the store is left as it is.
+        """
+        names = sorted(name for name in os.listdir(directory) if name.endswith(".sql")) if os.path.isdir(directory) else []
+        if not names:
+            return
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        with self._connect() as connection:
+            for name in names:
+                with open(os.path.join(directory, name), encoding="utf-8") as f:
+                    connection.executescript("BEGIN;\n" + f.read() + "COMMIT;\n")
+        logger.info("Loaded %s history tables from %s" % (len(names), directory))
+
+
+def _where(where):
+    if not where:
+        return "", []
+    conditions = []
+    params = []
+    for column, condition in where.items():
+        if isinstance(condition, tuple):
+            operator, value = condition
+            conditions.append('"%s" %s ?' % (column, operator))
+            params.append(_param(value))
+        elif isinstance(condition, (list, set)):
+            condition = list(condition)
+            conditions.append('"%s" IN (%s)' % (column, ", ".join("?" * len(condition))))
+            params.extend(_param(value) for value in condition)
+        else:
+            conditions.append('"%s" = ?' % column)
+            params.append(_param(condition))
+    return " WHERE " + " AND ".join(conditions), params
+
+
+def _param(value):
+    # sqlite3 does not bind numpy scalars
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+
+def _literal(value):
+    # SQL literal that reads back as the same value; repr keeps every digit of a float
+    if value is None:
+        return "NULL"
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "9e999" if value > 0 else "-9e999"
+        return repr(value)
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, bytes):
+        return "X'%s'" % value.hex()
+    return "'%s'" % value.replace("'", "''")
+
+
+if __name__ == "__main__":
+    import argparse
+    from retro_utils.context import RunContext
+
+    parser = argparse.ArgumentParser(description="Move the history store to and from its committed text dump")
+    parser.add_argument("command", choices=["load", "dump"])
+    args = parser.parse_args()
+
+    ctx = RunContext()
+    directory = ctx.config["files"]["history_dump"]
+    if args.command == "load":
+        ctx.store.load(directory)
+    else:
+        ctx.store.dump(directory)
@@ -0,0 +1,92 @@
+import time
+import copy
+import concurrent.futures
+import requests
+from requests.adapters import HTTPAdapter
+from application_logging.instrumentation import span, bind, count_response
+
+
+class SubgraphError(Exception):
+    pass
+
+
+def post_query(url, query, retries=3, timeout=60, backoff=2, session=None):
+    """Posts a GraphQL query and returns its ``data`` payload, retrying failed attempts."""
+    session = session or requests
+    for attempt in range(retries + 1):
+        try:
+            response = session.post(url, json=query, timeout=timeout)
+            count_response("subgraph", response)
+            response.raise_for_status()
+            body = response.json()
+            if body.get("errors"):
+                raise SubgraphError(body["errors"])
+            return body["data"]
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff ** attempt)
+
+
+@span("subgraph_pages")
+def paginate(url, query, entity, cursor_variable, cursor_field, page_size=1000, retries=3, timeout=60, session=None):
+    """Follows a cursor through every page of ``entity`` and returns all of its rows.
+
+    Each page asks for ``first: page_size`` rows and the next one starts after the
+    last row seen, by setting ``cursor_variable`` (e.g. ``lastId`` or ``startTime``)
+    to that row's ``cursor_field`` (e.g. ``id`` or ``date``). The query must order by
+    the same field and filter on it with ``_gt``.
+    """
+    rows = []
+    for page in iter_pages(url, query, entity, cursor_variable, cursor_field, page_size, retries, timeout, session):
+        rows.extend(page)
+    return rows
+
+
+def iter_pages(url, query, entity, cursor_variable, cursor_field, page_size=1000, retries=3, timeout=60, session=None):
+    """Like ``paginate``, but yields the pages as they arrive, for callers that stream them.
+
+    A page is only requested once the previous one has been consumed.
+    """
+    query = copy.deepcopy(query)
+    query["variables"]["first"] = page_size
+    while True:
+        page = post_query(url, query, retries, timeout, session=session)[entity]
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        query["variables"][cursor_variable] = page[-1][cursor_field]
+
+
+@span("subgraph")
+def fetch_concurrent(url, queries, max_workers=8, retries=3, timeout=60, pagination=None):
+    """Posts ``queries`` concurrently with at most ``max_workers`` in flight.
+
+    Returns one entry per query, in input order: its ``data`` payload, or the
+    exception raised by its last attempt. With ``pagination`` (the keyword
+    arguments of ``paginate``) each entry is instead the full list of rows.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=max_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if pagination:
+            futures = [
+                executor.submit(bind(paginate), url, query, retries=retries, timeout=timeout, session=session, **pagination)
+                for query in queries
+            ]
+        else:
+            futures = [
+                executor.submit(bind(post_query), url, query, retries, timeout, session=session)
+                for query in queries
+            ]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+    return results
@@ -1,75 +1,24 @@
-import requests
+import argparse
 import pandas as pd
 import numpy as np
-import yaml
-import json
-import os
-from datetime import datetime, timezone
-from dateutil.relativedelta import relativedelta, TH
 from application_logging.logger import logger
-import gspread
-from gspread_dataframe import set_with_dataframe
-from web3 import Web3
-from web3.middleware import validation
-import jmespath
-
-
-# Params
-params_path = "params.yaml"
-
-
-def read_params(config_path):
-    with open(config_path) as yaml_file:
-        config = yaml.safe_load(yaml_file)
-    return config
-
-
-config = read_params(params_path)
-
-try:
-    logger.info("Revenue Data Started")
-
-    # Params Data
-    bribe_data = config["files"]["bribe_data"]
-    fee_data = config["files"]["fee_data"]
-    pair_data = config["files"]["pair_data_fusion"]
-    vote_data = config["files"]["vote_data"]
-    emissions_data = config["files"]["emissions_data"]
-    provider_url = config["web3"]["provider_url"]
-    bribe_abi = config["web3"]["bribe_abi"]
-    price_api = config["api"]["price_api"]
-
-    # Read Data
-    bribe_df = pd.read_csv(bribe_data)
-    fee_df = pd.read_csv(fee_data)
-    pair_df = pd.read_csv(pair_data)
-    vote_df = pd.read_csv(vote_data)
-    emissions_df = pd.read_csv(emissions_data)
-
-    # Get Epoch Timestamp
-    todayDate = datetime.utcnow()
-    if todayDate.isoweekday() == 4 and todayDate.hour > 1:
-        nextThursday = todayDate + relativedelta(weekday=TH(2))
-        my_time = datetime.min.time()
-        my_datetime = datetime.combine(nextThursday, my_time)
-        timestamp = int(my_datetime.replace(tzinfo=timezone.utc).timestamp())
-        print("Yes, The next Thursday date:", my_datetime, timestamp)
-    else:
-        nextThursday = todayDate + relativedelta(weekday=TH(0))
-        my_time = datetime.min.time()
-        my_datetime = datetime.combine(nextThursday, my_time)
-        timestamp = int(my_datetime.replace(tzinfo=timezone.utc).timestamp())
-        print("No, The next Thursday date:", my_datetime, timestamp)
-
-    # Pull Prices
-    response = requests.get(price_api)
-    RETRO_price = jmespath.search("data[?name == 'RETRO'].price", response.json())[0]
-
-    # Web3
-    validation.METHODS_TO_VALIDATE = []
-    w3 = Web3(Web3.HTTPProvider(provider_url, request_kwargs={"timeout": 60}))
-
-    # Data Wrangling
+from application_logging.instrumentation import stage, span, report
+from retro_utils.epochs import epoch_of
+from retro_utils.context import RunContext
+
+
+# Input tables revenue is built from
+INPUT_TABLES = ["bribe_data", "fee_data", "pair_data_fusion", "vote_data", "emissions_data"]
+
+
+@span("build")
+def build_revenue(bribe_df, fee_df, pair_df, vote_df, emissions_df):
+    """Aggregates the stage outputs into one revenue row per epoch and pool.
+
+    Each epoch only needs its own rows plus the previous epoch's bribes (for
+    ``bribe_amount_offset``), so any epoch range can be built from inputs that
+    start one epoch earlier. The latest epoch is dropped as it is still running.
+    """
     pair_df.columns = [
         "id",
         "date",
@@ -126,29 +75,105 @@ try:
     latest_epoch = final_df["epoch"].iloc[-1]
     latest_data_index = final_df[final_df["epoch"] == latest_epoch].index
     final_df.drop(latest_data_index, inplace=True)
+    return final_df
 
-    # Write to GSheets
-    credentials = os.environ["GKEY"]
-    credentials = json.loads(credentials)
-    gc = gspread.service_account_from_dict(credentials)
-
-    # Open a google sheet
-    sheetkey = config["gsheets"]["revenue_data_sheet_key"]
-    gs = gc.open_by_key(sheetkey)
-
-    # Select a work sheet from its name
-    worksheet1 = gs.worksheet("Master")
-    worksheet1.clear()
-    set_with_dataframe(
-        worksheet=worksheet1,
-        dataframe=final_df,
-        include_index=False,
-        include_column_header=True,
-        resize=True,
-    )
 
-    logger.info("Revenue Data Ended")
-except Exception as e:
-    logger.error(
-        "Error occurred during Revenue Data process. Error: %s" % e, exc_info=True
+def read_inputs(store, where=None):
+    return [store.read(table, where=where) for table in INPUT_TABLES]
+
+
+def build_from(store, from_epoch):
+    """Builds the revenue rows of ``from_epoch`` on from the stored inputs.
+
+    Rows need the bribes of the epoch before, so inputs are read from there.
+    """
+    final_df = build_revenue(*read_inputs(store, where={"epoch": (">=", from_epoch - 1)}))
+    return final_df[final_df["epoch"] >= from_epoch]
+
+
+def assert_same_revenue(incremental_df, full_df):
+    # Row order within an epoch is not meaningful, compare by key
+    def by_key(df):
+        return df.sort_values(["epoch", "name_pool"], ignore_index=True)
+
+    pd.testing.assert_frame_equal(by_key(incremental_df), by_key(full_df), check_dtype=False)
+
+
+@stage("revenue_data")
+def run(ctx, verify=False):
+    config = ctx.config
+
+    try:
+        logger.info("Revenue Data Started")
+
+        # Get Epoch Timestamp
+        timestamp = ctx.epoch_timestamp
+
+        # Get Epoch
+        epoch = epoch_of(timestamp) - 1
+
+        # Only the running and the previous epoch can still change, unless a
+        # backfill rewrote older inputs (it rebuilds their revenue itself)
+        dirty_epoch = epoch - 1
+        dirty_scope = {"epoch": (">=", dirty_epoch)}
+
+        # Incremental Build
+        final_df = build_from(ctx.store, dirty_epoch)
+
+        sheetkey = config["gsheets"]["revenue_data_sheet_key"]
+
+        if verify:
+            # Full Rebuild
+            full_df = build_revenue(*read_inputs(ctx.store))
+            assert_same_revenue(final_df, full_df[full_df["epoch"] >= dirty_epoch])
+            logger.info("Revenue incremental build matches full rebuild from epoch %s" % dirty_epoch)
+
+            # Store Revenue Data
+            ctx.store.write("revenue_data", full_df, replace={})
+
+            # Replace the whole sheet, written directly as verify runs are manual
+            from gspread_dataframe import set_with_dataframe
+
+            gs = ctx.gspread_client.open_by_key(sheetkey)
+            worksheet1 = gs.worksheet("Master")
+            worksheet1.clear()
+            set_with_dataframe(
+                worksheet=worksheet1,
+                dataframe=full_df,
+                include_index=False,
+                include_column_header=True,
+                resize=True,
+            )
+        else:
+            # Store Revenue Data
+            ctx.store.write("revenue_data", final_df, replace=dirty_scope)
+
+            # Queue GSheets sync
+            ctx.publisher.sync(
+                sheetkey,
+                "Master",
+                final_df,
+                ["epoch", "name_pool"],
+                lambda keys: pd.to_numeric(keys["epoch"], errors="coerce") >= dirty_epoch,
+            )
+
+        logger.info("Revenue Data Ended")
+    except Exception as e:
+        logger.error(
+            "Error occurred during Revenue Data process. Error: %s" % e, exc_info=True
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build revenue data")
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Also rebuild from full history, check it against the incremental build and publish it",
     )
+    args = parser.parse_args()
+
+    ctx = RunContext()
+    run(ctx, verify=args.verify)
+    ctx.publisher.flush()
+    report()
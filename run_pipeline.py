@@ -0,0 +1,71 @@
+import argparse
+import concurrent.futures
+from application_logging.logger import logger
+from application_logging.instrumentation import report
+from retro_utils.context import RunContext
+import id_data
+import day_data
+import pair_data
+import bribe_data
+import fee_data
+import vote_data
+import revenue_data
+
+
+# Stage name -> (run function, stages it reads the output of)
+STAGES = {
+    "id_data": (id_data.run, []),
+    "day_data": (day_data.run, []),
+    "pair_data": (pair_data.run, ["id_data"]),
+    "bribe_data": (bribe_data.run, ["id_data"]),
+    "fee_data": (fee_data.run, ["id_data"]),
+    "vote_data": (vote_data.run, ["id_data"]),
+    "revenue_data": (revenue_data.run, ["pair_data", "bribe_data", "fee_data", "vote_data"]),
+}
+
+
+def run_pipeline(stages, ctx, max_workers=4):
+    """Runs ``stages`` over one shared context, each as soon as the stages it depends on are done.
+
+    Dependencies that were not selected are treated as already done. Every stage
+    logs its own failures, so a failed stage still releases the ones after it,
+    as it did when the workflow ran the scripts one after another.
+    """
+    pending = {name: [dep for dep in STAGES[name][1] if dep in stages] for name in stages}
+    done = set()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while pending or running:
+            for name in [name for name, deps in pending.items() if set(deps) <= done]:
+                logger.info("Pipeline stage %s started" % name)
+                running[executor.submit(STAGES[name][0], ctx)] = name
+                del pending[name]
+
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    logger.error("Pipeline stage %s failed. Error: %s" % (name, future.exception()))
+                logger.info("Pipeline stage %s ended" % name)
+                done.add(name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the data stages in one process")
+    parser.add_argument("stages", nargs="*", help="default: all stages")
+    parser.add_argument("--max-workers", type=int, default=4)
+    args = parser.parse_args()
+    # argparse rejects a list default of a nargs="*" positional with choices
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error("unknown stages: %s" % ", ".join(sorted(unknown)))
+    args.stages = args.stages or list(STAGES)
+
+    ctx = RunContext()
+    run_pipeline(args.stages, ctx, max_workers=args.max_workers)
+    # Sheets last, every stage's writes together
+    ctx.publisher.flush()
+    for stats in ctx.provider_stats():
+        logger.info("RPC endpoint stats: %s" % stats)
+    report()
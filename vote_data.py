@@ -1,120 +1,98 @@
-import requests
 import pandas as pd
-import yaml
-import json
-import os
-from datetime import datetime, timezone
-from dateutil.relativedelta import relativedelta, TH
 from application_logging.logger import logger
-import gspread
-from web3 import Web3
-from web3.middleware import validation
-import jmespath
+from application_logging.instrumentation import stage, span, report
+from retro_utils.rpc_batch import RPCBatch, RPCError
+from retro_utils.epochs import epoch_of
+from retro_utils.abis import load_functions
+from retro_utils.context import RunContext
 
 
-# Params
-params_path = "params.yaml"
+@span("fetch")
+def fetch_vote_weights(ctx, ids_df, timestamp):
+    """Reads each gauge's vote weight (its bribe contract's ``totalSupplyAt``) at ``timestamp``."""
+    config = ctx.config
 
-
-def read_params(config_path):
-    with open(config_path) as yaml_file:
-        config = yaml.safe_load(yaml_file)
-    return config
-
-
-config = read_params(params_path)
-
-try:
     # Params Data
-    id_data = config["files"]["id_data"]
     provider_url = config["web3"]["provider_url"]
-    bribe_abi = config["web3"]["bribe_abi"]
-    epoch_csv = config["files"]["epoch_data"]
-    price_api = config["api"]["price_api"]
-    vote_csv = config["files"]["vote_data"]
-
-    # Pulling Vote Data
-    logger.info("Vote Data Started")
-
-    # Get Epoch Timestamp
-    todayDate = datetime.utcnow()
-    if todayDate.isoweekday() == 4 and todayDate.hour > 1:
-        nextThursday = todayDate + relativedelta(weekday=TH(2))
-        my_time = datetime.min.time()
-        my_datetime = datetime.combine(nextThursday, my_time)
-        timestamp = int(my_datetime.replace(tzinfo=timezone.utc).timestamp())
-        print("Yes, The next Thursday date:", my_datetime, timestamp)
-    else:
-        nextThursday = todayDate + relativedelta(weekday=TH(0))
-        my_time = datetime.min.time()
-        my_datetime = datetime.combine(nextThursday, my_time)
-        timestamp = int(my_datetime.replace(tzinfo=timezone.utc).timestamp())
-        print("No, The next Thursday date:", my_datetime, timestamp)
-
-    # Read Epoch Data
-    epoch_data = pd.read_csv(epoch_csv)
-    epoch = epoch_data[epoch_data["timestamp"] == timestamp]["epoch"].values[0] - 1
-
-    # Read IDS Data
-    vote_df = pd.read_csv(id_data)
-    vote_df["epoch"] = epoch
-
-    # Pull Prices
-    response = requests.get(price_api)
-    RETRO_price = jmespath.search("data[?name == 'RETRO'].price", response.json())[0]
+    total_supply_at = load_functions("bribe")["totalSupplyAt"]
+
+    # Pull Votes Web3
+    calldata = total_supply_at.encode(timestamp)
+    bribes = [
+        bribe
+        for bribe in ids_df["gauge.bribe"]
+        if bribe != "0x0000000000000000000000000000000000000000"
+    ]
+    rpc_batch = RPCBatch(
+        ctx.provider_pool(provider_url), chunk_size=config["web3"]["rpc_batch_size"], timeout=60
+    )
+    results = rpc_batch.eth_call([(bribe, calldata) for bribe in bribes], retries=1)
 
-    # Pull Fees Web3
-    validation.METHODS_TO_VALIDATE = []
-    w3 = Web3(Web3.HTTPProvider(provider_url, request_kwargs={"timeout": 60}))
+    total_supply = {}
+    for bribe, result in zip(bribes, results):
+        if isinstance(result, RPCError):
+            raise RPCError({"message": "totalSupplyAt failed for %s: %s" % (bribe, result)})
+        total_supply[bribe] = total_supply_at.decode(result)
 
     voteweight = []
-    for bribe in vote_df["gauge.bribe"]:
+    for bribe in ids_df["gauge.bribe"]:
         if bribe == "0x0000000000000000000000000000000000000000":
             voteweight.append(0)
         else:
-            contract_instance = w3.eth.contract(address=bribe, abi=bribe_abi)
-            voteweight.append(
-                round(
-                    (
-                        contract_instance.functions.totalSupplyAt(timestamp).call()
-                        / 1000000000000000000
-                    ),
-                    2,
-                )
-            )
-
-    vote_df["voteweight"] = voteweight
+            voteweight.append(round(total_supply[bribe] / 1000000000000000000, 2))
+
+    return pd.DataFrame({"symbol": ids_df["symbol"].values, "voteweight": voteweight})
+
+
+@span("build")
+def vote_values(vote_df, prices, epoch):
+    """Values the vote weights of ``fetch_vote_weights`` and shapes them into ``epoch``'s rows."""
+    vote_df["epoch"] = epoch
     vote_df = vote_df[["symbol", "epoch", "voteweight"]]
-    vote_df["RETRO_price"] = RETRO_price
+    vote_df["RETRO_price"] = prices.price("RETRO")
     vote_df["votevalue"] = vote_df["voteweight"] * vote_df["RETRO_price"]
     vote_df.columns = ["name_pool", "epoch", "voteweight", "RETRO_price", "votevalue"]
+    return vote_df
 
-    # Rewriting current Epoch's Vote Data
-    voter = pd.read_csv(vote_csv)
-    drop_index = voter[voter["epoch"] == epoch].index
-    index_list = drop_index.to_list()
-    index_list = list(map(lambda x: x + 2, index_list))
-    df_values = vote_df.values.tolist()
-
-    # Write to GSheets
-    credentials = os.environ["GKEY"]
-    credentials = json.loads(credentials)
-    gc = gspread.service_account_from_dict(credentials)
-
-    # Open a google sheet
-    sheetkey = config["gsheets"]["vote_data_sheet_key"]
-    gs = gc.open_by_key(sheetkey)
-
-    # Select a work sheet from its name
-    worksheet1 = gs.worksheet("Master")
-    if index_list != []:
-        worksheet1.delete_rows(index_list[0], index_list[-1])
-        
-    # Append to Worksheet
-    gs.values_append("Master", {"valueInputOption": "USER_ENTERED"}, {"values": df_values})
-
-    logger.info("Vote Data Ended")
-except Exception as e:
-    logger.error(
-        "Error occurred during Vote Data process. Error: %s" % e, exc_info=True
-    )
+
+@stage("vote_data")
+def run(ctx):
+    config = ctx.config
+
+    try:
+        # Pulling Vote Data
+        logger.info("Vote Data Started")
+
+        # Get Epoch Timestamp
+        timestamp = ctx.epoch_timestamp
+
+        # Get Epoch
+        epoch = epoch_of(timestamp) - 1
+
+        # Read IDS Data
+        ids_df = ctx.ids_df
+
+        vote_df = fetch_vote_weights(ctx, ids_df, timestamp)
+
+        # Pull Prices
+        vote_df = vote_values(vote_df, ctx.prices, epoch)
+
+        # Store current Epoch's rows
+        ctx.store.write("vote_data", vote_df, replace={"epoch": epoch})
+
+        # Queue GSheets sync
+        sheetkey = config["gsheets"]["vote_data_sheet_key"]
+        ctx.publisher.sync(sheetkey, "Master", vote_df, ["epoch", "name_pool"], lambda keys: keys["epoch"] == str(epoch))
+
+        logger.info("Vote Data Ended")
+    except Exception as e:
+        logger.error(
+            "Error occurred during Vote Data process. Error: %s" % e, exc_info=True
+        )
+
+
+if __name__ == "__main__":
+    ctx = RunContext()
+    run(ctx)
+    ctx.publisher.flush()
+    report()